@@ -0,0 +1,81 @@
+"""Latency of InteractiveCoarseGraph.adjacency() against visible node count.
+
+Compares the block-based assembly with the previous LIL-based assembly on a
+synthetic dataset. Run from the repository root with
+``python -m benchmarks.adjacency``.
+"""
+import argparse
+import time
+
+import graphtools
+import numpy as np
+from scipy import sparse
+
+from h_phate.graph import CoarseGraph
+from h_phate.interactive import InteractiveCoarseGraph
+
+from .synthetic import synthetic_data
+
+
+def lil_adjacency(icg_op):
+    level_boundaries = icg_op.level_boundaries()
+    N = level_boundaries[-1]
+    A = icg_op.cg_op.adjacency
+    A_combined = sparse.lil_matrix((N, N))
+    for to_level in range(icg_op.cg_op.n_levels):
+        to_level_idx = np.arange(level_boundaries[to_level], level_boundaries[to_level+1])
+        if len(to_level_idx) == 0:
+            continue
+        for from_level in range(0, to_level+1):
+            from_level_idx = np.arange(level_boundaries[from_level], level_boundaries[from_level + 1])
+            if len(from_level_idx) == 0:
+                continue
+            A_submatrix = A[(to_level, from_level)][icg_op.level_nodes[to_level]][:,icg_op.level_nodes[from_level]]
+            graphtools.matrix.set_submatrix(A_combined, to_level_idx, from_level_idx, A_submatrix)
+            if from_level != to_level:
+                graphtools.matrix.set_submatrix(A_combined, from_level_idx, to_level_idx, A_submatrix.T)
+    return graphtools.matrix.set_diagonal(A_combined, 1)
+
+
+def timeit(fn, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return np.min(times)
+
+
+def main(n_cells=20000, repeats=3, expand_fraction=0.2, seed=42):
+    rng = np.random.RandomState(seed)
+    cg_op = CoarseGraph().fit(synthetic_data(n_cells, seed=seed))
+    icg_op = InteractiveCoarseGraph(cg_op)
+    print("{:>8} {:>10} {:>10} {:>10} {:>8}".format(
+        "nodes", "lil (s)", "cold (s)", "warm (s)", "speedup"))
+    while True:
+        n_nodes = icg_op.n_nodes()
+        lil_time = timeit(lambda: lil_adjacency(icg_op), repeats)
+
+        def cold():
+            icg_op._adjacency_blocks.clear()
+            icg_op.adjacency()
+        cold_time = timeit(cold, repeats)
+        warm_time = timeit(icg_op.adjacency, repeats)
+        print("{:>8} {:>10.4f} {:>10.4f} {:>10.4f} {:>7.1f}x".format(
+            n_nodes, lil_time, cold_time, warm_time, lil_time / cold_time))
+
+        coarse_idx = np.flatnonzero(np.repeat(np.arange(cg_op.n_levels) > 0,
+                                              icg_op.level_sizes()))
+        if len(coarse_idx) == 0:
+            break
+        n_select = max(1, int(expand_fraction * n_nodes))
+        icg_op.refine(rng.choice(coarse_idx, min(n_select, len(coarse_idx)), replace=False))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--n-cells", type=int, default=20000)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--expand-fraction", type=float, default=0.2)
+    args = parser.parse_args()
+    main(n_cells=args.n_cells, repeats=args.repeats, expand_fraction=args.expand_fraction)
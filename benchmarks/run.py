@@ -0,0 +1,187 @@
+"""Time and peak memory of the fit, interaction and colouring paths on synthetic data.
+
+Run from the repository root, for example::
+
+    python -m benchmarks.run --scales 5000 50000 500000 --output results.json
+    python -m benchmarks.run --output new.json --compare results.json
+
+Results are written as JSON: one record per (scale, benchmark) with the
+wall time in seconds, the peak traced memory in bytes and the size of the
+view it ran on.
+"""
+import argparse
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+
+import graph_coarsening
+import numpy as np
+
+from h_phate.dashboard import PlotlyDashboard
+from h_phate.graph import CoarseGraph
+from h_phate.hierarchy import HierarchyIndex
+from h_phate.interactive import InteractiveCoarseGraph
+
+from .synthetic import synthetic_data
+
+
+def measure(fn, memory=True):
+    """Runs `fn` once and returns its result, wall time and peak traced memory."""
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = fn()
+        seconds = time.perf_counter() - start
+        peak_bytes = tracemalloc.get_traced_memory()[1] if memory else None
+    finally:
+        if memory:
+            tracemalloc.stop()
+    return result, seconds, peak_bytes
+
+
+class Recorder():
+
+    def __init__(self, scale, memory=True):
+        self.scale = scale
+        self.memory = memory
+        self.records = []
+
+    def __call__(self, name, fn, **info):
+        result, seconds, peak_bytes = measure(fn, memory=self.memory)
+        record = dict(scale=self.scale, benchmark=name, seconds=seconds, peak_bytes=peak_bytes, **info)
+        self.records.append(record)
+        print("{:>8} {:<28} {:>10.4f} s {:>12}".format(
+            self.scale, name, seconds,
+            "" if peak_bytes is None else "{:.1f} MB".format(peak_bytes / 2**20)))
+        return result
+
+
+def clear_view_caches(icg_op):
+    icg_op._adjacency_blocks.clear()
+    icg_op._embedding_cache.clear()
+    icg_op._gene_embedding_cache.clear()
+    icg_op._gene_expression_cache.clear()
+    icg_op.cg_op.adjacency.cache.clear()
+
+
+def coarse_nodes_idx(icg_op):
+    """Indices of the visible nodes above level 0."""
+    return np.flatnonzero(np.repeat(np.arange(icg_op.cg_op.n_levels) > 0, icg_op.level_sizes()))
+
+
+def bench_scale(n_cells, select_fraction=0.1, memory=True, seed=42):
+    rng = np.random.RandomState(seed)
+    record = Recorder(n_cells, memory=memory)
+    data = synthetic_data(n_cells, seed=seed)
+
+    cg_op = record("fit", lambda: CoarseGraph(random_state=seed).fit(data))
+    record("_build_graph", lambda: cg_op._build_graph(data))
+    record("coarsen", lambda: graph_coarsening.coarsen(
+        cg_op.graphs[0], K=cg_op.K, r=cg_op.r, method=cg_op.method, algorithm=cg_op.algorithm))
+    record("_build_map_refine", lambda: cg_op._build_map_refine(cg_op.map_coarsen))
+    record("_build_parents", cg_op._build_parents)
+    record("HierarchyIndex", lambda: HierarchyIndex(cg_op.parents, cg_op.level_sizes))
+    record("_build_node_sizes", cg_op._build_node_sizes)
+    record("_build_gene_expression", cg_op._build_gene_expression)
+    record("_build_adjacencies", cg_op._build_adjacencies)
+
+    icg_op = InteractiveCoarseGraph(cg_op)
+    info = dict(n_nodes=int(icg_op.n_nodes()))
+    record("embed", icg_op.embed, **info)
+    record("embed_genes", icg_op.embed_genes, **info)
+
+    coarse_idx = coarse_nodes_idx(icg_op)
+    select_idx = rng.choice(coarse_idx, max(1, int(select_fraction * len(coarse_idx))), replace=False)
+    record("refine (to cells, view unchanged)",
+           lambda: icg_op._refined_mask(select_idx, False, None, to_level=0), n_selected=len(select_idx))
+    record("refine", lambda: icg_op.refine(select_idx), n_selected=len(select_idx))
+    info = dict(n_nodes=int(icg_op.n_nodes()))
+
+    clear_view_caches(icg_op)
+    A = record("adjacency", icg_op.adjacency, **info)
+    info['nnz'] = int(A.nnz)
+    record("adjacency (warm)", icg_op.adjacency, **info)
+    record("embed (incremental)", lambda: icg_op.embed(incremental=True), **info)
+    clear_view_caches(icg_op)
+    record("embed (cold)", lambda: icg_op.embed(incremental=False), **info)
+    landmark_op = InteractiveCoarseGraph(cg_op, n_landmark=500)
+    record("embed (500 landmarks)", lambda: landmark_op.embed(level_nodes=icg_op.level_nodes), **info)
+    record("embed_genes (refined)", icg_op.embed_genes, **info)
+
+    gene_idx = rng.choice(len(cg_op.gene_list), 5, replace=False)
+    node_idx = rng.choice(icg_op.n_nodes(), max(1, icg_op.n_nodes() // 10), replace=False)
+
+    def color_by_gene():
+        X = icg_op.gene_expression(format='csr')
+        return PlotlyDashboard._scale_colors(X[gene_idx].sum(axis=0))
+
+    def color_by_cluster():
+        X = icg_op.gene_expression(format='csc')
+        return PlotlyDashboard._scale_colors(X[:,node_idx].sum(axis=1))
+
+    icg_op._gene_expression_cache.clear()
+    record("color_by_gene (cold)", color_by_gene, **info)
+    record("color_by_gene (warm)", color_by_gene, **info)
+    record("color_by_cluster (warm)", color_by_cluster, **info)
+
+    remove_idx = rng.choice(icg_op.n_nodes(), max(1, int(select_fraction * icg_op.n_nodes())), replace=False)
+    record("remove", lambda: icg_op.remove(remove_idx), n_selected=len(remove_idx))
+    return record.records
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(records, baseline_records):
+    baseline = {(r['scale'], r['benchmark']): r for r in baseline_records}
+    print("{:>8} {:<28} {:>10} {:>10}".format("scale", "benchmark", "time", "memory"))
+    for r in records:
+        b = baseline.get((r['scale'], r['benchmark']))
+        if b is None:
+            continue
+        memory_ratio = ("" if not r['peak_bytes'] or not b['peak_bytes']
+                        else "{:.2f}x".format(r['peak_bytes'] / b['peak_bytes']))
+        print("{:>8} {:<28} {:>9.2f}x {:>10}".format(
+            r['scale'], r['benchmark'], r['seconds'] / b['seconds'], memory_ratio))
+
+
+def main(scales, output=None, baseline=None, memory=True, select_fraction=0.1):
+    records = []
+    for n_cells in scales:
+        records.extend(bench_scale(n_cells, select_fraction=select_fraction, memory=memory))
+    results = dict(
+        revision=git_revision(),
+        timestamp=time.strftime("%Y-%m-%dT%H:%M:%S"),
+        python=platform.python_version(),
+        machine=platform.machine(),
+        records=records,
+    )
+    if output is not None:
+        with open(output, 'w') as handle:
+            json.dump(results, handle, indent=1)
+    if baseline is not None:
+        with open(baseline) as handle:
+            compare(records, json.load(handle)['records'])
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", type=int, nargs="+", default=[5000, 50000])
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare against")
+    parser.add_argument("--select-fraction", type=float, default=0.1)
+    parser.add_argument("--no-memory", action="store_true",
+                        help="skip tracemalloc, which slows down allocation-heavy stages")
+    args = parser.parse_args()
+    main(args.scales, output=args.output, baseline=args.compare,
+         memory=not args.no_memory, select_fraction=args.select_fraction)
@@ -0,0 +1,45 @@
+"""Synthetic sparse count matrices for benchmarks, generated without network access."""
+import numpy as np
+import pandas as pd
+import scprep
+from scipy import sparse
+
+from h_phate.data import normalize
+
+
+def synthetic_counts(n_cells, n_genes=2000, n_clusters=20, genes_per_cell=200, seed=42):
+    """Sparse cells x genes counts drawn from cluster-specific gene distributions.
+
+    Each cell draws `genes_per_cell` gene indices (with replacement) from the
+    distribution of its cluster, so memory grows linearly with `n_cells`.
+
+    Returns
+    -------
+    counts : scprep.utils.SparseDataFrame, shape=[n_cells, n_genes]
+    labels : array-like, shape=[n_cells]
+        cluster of each cell
+    """
+    rng = np.random.RandomState(seed)
+    gene_weights = rng.gamma(0.3, 1, (n_clusters, n_genes))
+    gene_weights /= gene_weights.sum(axis=1, keepdims=True)
+    labels = rng.randint(n_clusters, size=n_cells)
+    rows, cols = [], []
+    for cluster in range(n_clusters):
+        cells = np.flatnonzero(labels == cluster)
+        rows.append(np.repeat(cells, genes_per_cell))
+        cols.append(rng.choice(n_genes, size=len(cells) * genes_per_cell, p=gene_weights[cluster]))
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    counts = sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)),
+                               shape=(n_cells, n_genes))
+    counts.sum_duplicates()
+    counts = scprep.utils.SparseDataFrame(
+        counts,
+        index=pd.Index(["cell{}".format(i) for i in range(n_cells)]),
+        columns=pd.Index(["gene{}".format(i) for i in range(n_genes)]))
+    return counts, labels
+
+
+def synthetic_data(n_cells, seed=42, **kwargs):
+    """Normalized synthetic data, as returned by the `h_phate.data` loaders."""
+    counts, _ = synthetic_counts(n_cells, seed=seed, **kwargs)
+    return normalize(counts)
@@ -1,2 +1,4 @@
 from .h_phate import H_PHATE
-from . import data
\ No newline at end of file
+from . import data
+from . import profiling
+from . import batch
@@ -0,0 +1,154 @@
+"""Headless drill-down embeddings computed across a process pool.
+
+Examples
+--------
+Every top-level node zoomed into two levels down:
+
+>>> top = cg_op.n_levels - 1
+>>> specs = [dict(level=top, nodes=[i], action='zoom', depth=2)
+...          for i in range(cg_op.level_sizes[top])]
+>>> for i, result in h_phate.batch.embed_selections(cg_op, specs, n_jobs=8):
+...     Y, node_sizes = result['Y'], result['node_sizes']
+"""
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from .graph import CoarseGraph
+from .interactive import InteractiveCoarseGraph
+
+_ACTIONS = ['refine', 'zoom', 'remove']
+
+# fitted hierarchy shared by the jobs of a worker process
+_worker_cg_op = None
+
+
+def _selection_idx(icg_op, level, nodes):
+    """Indices in the current view of `nodes` at `level`."""
+    visible = icg_op.level_nodes[level]
+    idx = np.searchsorted(visible, nodes)
+    idx = np.minimum(idx, len(visible) - 1)
+    if len(visible) == 0 or np.any(visible[idx] != nodes):
+        raise ValueError("Selected nodes {} are not visible at level {}".format(
+            np.setdiff1d(nodes, visible), level))
+    return icg_op.level_boundaries()[level] + idx
+
+
+def apply_selection(icg_op, spec):
+    """Applies a selection spec to an InteractiveCoarseGraph.
+
+    Parameters
+    ----------
+    icg_op : InteractiveCoarseGraph
+    spec : dict
+        level : int
+            level of the selected nodes
+        nodes : list-like or None, optional (default: None)
+            selected nodes at `level`. If None, selects all visible nodes of `level`.
+        action : {'refine', 'zoom', 'remove'}, optional (default: 'refine')
+            'zoom' refines the selection and removes everything else
+        depth : int, optional (default: 1)
+            number of levels to refine
+        level_nodes : list of arrays or None, optional (default: None)
+            starting view. If None, starts from the initial view.
+
+    Returns
+    -------
+    icg_op : InteractiveCoarseGraph
+    """
+    action = spec.get('action', 'refine')
+    if action not in _ACTIONS:
+        raise ValueError("Expected action in {}. Got {}".format(_ACTIONS, action))
+    if spec.get('level_nodes') is None:
+        icg_op.initialize()
+    else:
+        icg_op.level_nodes = [np.asarray(nodes, dtype=int) for nodes in spec['level_nodes']]
+    level = spec['level']
+    nodes = spec.get('nodes')
+    nodes = icg_op.level_nodes[level] if nodes is None else np.unique(np.asarray(nodes, dtype=int))
+    select_idx = _selection_idx(icg_op, level, nodes)
+    if action == 'remove':
+        icg_op.remove(select_idx)
+        return icg_op
+    icg_op.refine(select_idx, remove_deselected=action == 'zoom',
+                  to_level=max(level - spec.get('depth', 1), 0))
+    return icg_op
+
+
+def _run(cg_op, spec, embed_genes, icg_params):
+    icg_op = apply_selection(InteractiveCoarseGraph(cg_op, **icg_params), spec)
+    Y, node_sizes = icg_op.embed()
+    result = dict(spec=spec, level_nodes=icg_op.level_nodes, Y=Y, node_sizes=node_sizes)
+    if embed_genes:
+        result['Y_genes'], result['gene_list'], result['gene_idx'] = icg_op.embed_genes()
+    return result
+
+
+def _init_worker(path):
+    global _worker_cg_op
+    _worker_cg_op = CoarseGraph.load(path, mmap_mode='r')
+
+
+def _run_worker(spec, embed_genes, icg_params):
+    return _run(_worker_cg_op, spec, embed_genes, icg_params)
+
+
+def embed_selections(cg_op, specs, n_jobs=1, embed_genes=False, **icg_params):
+    """Embeds a batch of selections, yielding each result as soon as it is ready.
+
+    Worker processes memory-map one saved hierarchy, so they share its pages.
+    A fitted `CoarseGraph` that was not loaded from disk is saved to a
+    temporary directory for the duration of the batch.
+
+    Parameters
+    ----------
+    cg_op : CoarseGraph or str
+        fitted hierarchy, or a directory written by `CoarseGraph.save`
+    specs : list of dict
+        selections, see `apply_selection`
+    n_jobs : int, optional (default: 1)
+        number of worker processes. If 1, runs in this process.
+    embed_genes : bool, optional (default: False)
+        also embed the gene graph of each view
+    icg_params : additional keyword arguments
+        passed to `InteractiveCoarseGraph`
+
+    Yields
+    ------
+    i : int
+        index of the spec in `specs`
+    result : dict
+        `spec`, `level_nodes`, `Y` and `node_sizes`, plus `Y_genes`,
+        `gene_list` and `gene_idx` if `embed_genes`
+    """
+    if n_jobs == 1:
+        if isinstance(cg_op, str):
+            cg_op = CoarseGraph.load(cg_op)
+        for i, spec in enumerate(specs):
+            yield i, _run(cg_op, spec, embed_genes, icg_params)
+        return
+    tempdir = None
+    if isinstance(cg_op, str):
+        path = cg_op
+    elif getattr(cg_op, 'path', None) is not None:
+        path = cg_op.path
+    else:
+        tempdir = tempfile.mkdtemp(prefix="h_phate_")
+        path = tempdir
+        cg_op.save(path)
+    try:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker,
+                                 initargs=(path,)) as executor:
+            futures = {executor.submit(_run_worker, spec, embed_genes, icg_params): i
+                       for i, spec in enumerate(specs)}
+            try:
+                for future in as_completed(futures):
+                    yield futures[future], future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+    finally:
+        if tempdir is not None:
+            shutil.rmtree(tempdir, ignore_errors=True)
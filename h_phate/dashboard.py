@@ -1,39 +1,170 @@
 import plotly.graph_objs as go
 import ipywidgets as widgets
-import matplotlib as mpl
+from matplotlib import cm
+from matplotlib.colors import to_hex
 import numpy as np
+import threading
+
+from .utils import Lock, BackgroundWorker
+from . import profiling
+
+# plotly 3 only names the colorscales up to Viridis, so Inferno is passed explicitly
+_INFERNO = [[float(t), to_hex(cm.inferno(t))] for t in np.linspace(0, 1, 11)]
+# seconds without pan or zoom events before the points are regrouped
+_VIEWPORT_DELAY = 0.2
 
-from .utils import Lock
 
 class PlotlyDashboard():
     
-    def __init__(self, icg_op):
+    def __init__(self, icg_op, prefetch=0, webgl=False, max_points=None):
         self.icg_op = icg_op
+        self.prefetch = prefetch
+        self.webgl = webgl
+        self.max_points = max_points
+        # last values sent to each trace, see `_update_trace`
+        self._sent = dict()
+        self._viewport = None
+        self._viewport_timer = None
+        # ancestor groups of the drawn nodes per level, see `_ancestor_groups`
+        self._groups_cache = (None, dict())
         self.selected_idx = None
         self.lock = False
+        self.worker = BackgroundWorker()
+        self.gene_worker = BackgroundWorker()
+        # expansions are embedded ahead of time on their own thread, so real work never queues behind them
+        self.prefetch_worker = BackgroundWorker()
+        self.figure_lock = threading.Lock()
+        self._pending = dict()
         self.initialize_figure()
         self.initialize_gene_figure()
         self.initialize_buttons()
         self.lock = Lock().lock
+        self.prefetch_expansions()
     
     def initialize_figure(self):
-        Y, node_sizes = self.icg_op.embed()
+        # nodes currently drawn; may lag behind icg_op.level_nodes while embedding
+        self.level_nodes = self.icg_op.level_nodes
+        self.Y, self.node_sizes = self.icg_op.embed(level_nodes=self.level_nodes)
+        self.node_colors = None
         self.fig = go.FigureWidget(layout=dict(
             dragmode="lasso", hovermode="closest", 
             title=dict(text="Cells Graph"),
             xaxis=dict(showgrid=False, visible=False), 
             yaxis=dict(showgrid=False, visible=False)
         ))
-        self.fig.add_scatter(x=Y[:,0], y=Y[:,1], mode='markers', 
+        add_trace = self.fig.add_scattergl if self.webgl else self.fig.add_scatter
+        add_trace(mode='markers', 
                         marker=dict(
-                            size=node_sizes, 
                             line=dict(width=0), 
                             opacity=0.4,
                             sizemin=1,
-                            sizeref=2. * np.max(node_sizes) / (6 ** 2) ,
+                            colorscale=_INFERNO,
+                            cmin=0,
+                            cmax=1,
                         ))
+        self._draw()
         self.fig.data[0].on_selection(self.select)
         self.fig.data[0].on_click(self.click_cells_point)
+        if self.max_points is not None:
+            self.fig.layout.on_change(self._on_viewport, 'xaxis.range', 'yaxis.range')
+
+    def _update_trace(self, trace, **attrs):
+        """Sends the attributes of `trace` that differ from the values last sent.
+
+        Attribute names use underscores for nesting, e.g. `marker_size`.
+        Changes are detected per attribute: plotly widgets replace whole
+        arrays, so moving a single point sends all of `x` and `y` again.
+        """
+        sent = self._sent.setdefault(id(trace), dict())
+        changed = dict()
+        for name, value in attrs.items():
+            if name in sent and np.array_equal(sent[name], value):
+                continue
+            sent[name] = changed[name] = value
+        if len(changed) > 0:
+            trace.update(**changed)
+
+    def _level_of_detail(self):
+        """Drawn point of each node, or None if every node is drawn.
+
+        Nodes in the viewport are merged into their ancestors at the lowest
+        level that leaves at most `max_points` points; nodes outside it are
+        merged into their top-level ancestors.
+        """
+        if self.max_points is None or len(self.Y) <= self.max_points:
+            return None
+        inside = np.ones(len(self.Y), dtype=bool)
+        if self._viewport is not None:
+            for dim, (lower, upper) in enumerate(self._viewport):
+                inside &= (self.Y[:,dim] >= lower) & (self.Y[:,dim] <= upper)
+        top = self.icg_op.cg_op.n_levels - 1
+        outside = self._ancestor_groups(top)
+        for level in range(top + 1):
+            groups = self._ancestor_groups(level)
+            if level < top:
+                # groups at different levels never share a node
+                _, groups = np.unique(np.where(inside, groups, groups.max() + 1 + outside),
+                                      return_inverse=True)
+            if groups.max() < self.max_points:
+                break
+        return groups
+
+    def _ancestor_groups(self, level):
+        """`ancestor_groups` of the drawn nodes at `level`, cached until they change."""
+        level_nodes, cache = self._groups_cache
+        if level_nodes is not self.level_nodes:
+            self._groups_cache = level_nodes, cache = self.level_nodes, dict()
+        if level not in cache:
+            cache[level] = self.icg_op.ancestor_groups(level, level_nodes)
+        return cache[level]
+
+    def _members(self, point_idx):
+        """Indices of the nodes drawn as the points `point_idx`."""
+        point_idx = np.asarray(point_idx, dtype=int)
+        if self.groups is None:
+            return point_idx
+        return np.flatnonzero(np.isin(self.groups, point_idx))
+
+    def _aggregate(self, values):
+        """Size-weighted mean of `values` over the nodes of each drawn point."""
+        if self.groups is None:
+            return values
+        weights = np.bincount(self.groups, weights=self.node_sizes)
+        if values.ndim == 1:
+            return np.bincount(self.groups, weights=values * self.node_sizes) / weights
+        return np.column_stack([self._aggregate(values[:,i]) for i in range(values.shape[1])])
+
+    def _draw(self):
+        """Draws the embedding, merging nodes into their ancestors if `max_points` is set."""
+        self.groups = self._level_of_detail()
+        Y = self._aggregate(self.Y).astype(np.float32)
+        sizes = (self.node_sizes if self.groups is None else
+                 np.bincount(self.groups, weights=self.node_sizes)).astype(np.float32)
+        self._update_trace(
+            self.fig.data[0], x=Y[:,0], y=Y[:,1], marker_size=sizes,
+            marker_sizeref=2. * np.max(sizes) / (6 ** 2))
+        self._draw_colors()
+
+    def _draw_colors(self):
+        colors = None if self.node_colors is None else self._aggregate(self.node_colors).astype(np.float32)
+        self._update_trace(self.fig.data[0], marker_color=colors)
+
+    def _on_viewport(self, layout, x_range, y_range):
+        """Regroups the points once panning or zooming pauses for `_VIEWPORT_DELAY` seconds."""
+        viewport = None if x_range is None or y_range is None else (x_range, y_range)
+        if viewport == self._viewport:
+            return
+        self._viewport = viewport
+        if self._viewport_timer is not None:
+            self._viewport_timer.cancel()
+        self._viewport_timer = threading.Timer(_VIEWPORT_DELAY, self._redraw_viewport)
+        self._viewport_timer.daemon = True
+        self._viewport_timer.start()
+
+    def _redraw_viewport(self):
+        with self.figure_lock, self.fig.batch_update():
+            self._draw()
+            self.selected_idx = None
     
     def initialize_gene_figure(self):
         Y, gene_list, self.gene_idx = self.icg_op.embed_genes()
@@ -51,84 +182,165 @@ class PlotlyDashboard():
                             opacity=0.4,
                             sizemin=1,
                             sizeref=2. * np.max(node_sizes) / (6 ** 2) ,
+                            colorscale=_INFERNO,
+                            cmin=0,
+                            cmax=1,
                         ))
         self.gene_fig.data[0].on_click(self.click_genes_point)
         self.gene_fig.data[0].on_selection(self.click_genes_point)
     
     def initialize_buttons(self):
         self.expand_button = widgets.Button(description="Expand")
+        self.cells_button = widgets.Button(description="Expand to cells")
         self.zoom_button = widgets.Button(description="Zoom")
         self.filter_button = widgets.Button(description="Filter")
+        self.back_button = widgets.Button(description="Back")
+        self.forward_button = widgets.Button(description="Forward")
         self.reset_button = widgets.Button(description="Reset")
         self.genes_button = widgets.Button(description="Rebuild gene graph")
+        self.status = widgets.HTML()
         self.expand_button.on_click(self.click_expand)
+        self.cells_button.on_click(self.click_cells)
         self.zoom_button.on_click(self.click_zoom)
         self.filter_button.on_click(self.click_filter)
+        self.back_button.on_click(self.click_back)
+        self.forward_button.on_click(self.click_forward)
         self.reset_button.on_click(self.click_reset)
         self.genes_button.on_click(self.click_genes_button)
     
     def select(self, trace, points, selector):
         self.click_cells_point(trace, points, selector)
-        self.selected_idx = np.array(points.point_inds, dtype=int)
+        self.selected_idx = self._members(points.point_inds)
     
+    def _update_status(self):
+        self.status.value = " ".join(self._pending.values())
+
+    def run_in_background(self, worker, message, fn, callback, name="job"):
+        """Runs `fn` on `worker` and applies its result with `callback`.
+
+        A newer job on the same worker supersedes this one. Any prefetching
+        is cancelled, so it stops at its next stage.
+        """
+        self.prefetch_worker.cancel()
+        self._pending[worker] = message
+        self._update_status()
+
+        def apply(result):
+            with self.figure_lock:
+                callback(result)
+            self._pending.pop(worker, None)
+            self._update_status()
+
+        def on_error(err):
+            self._pending[worker] = "Error: {}".format(err)
+            self._update_status()
+
+        worker.submit(fn, apply, on_error=on_error, name=name)
+
     def rebuild(self):
-        Y, node_sizes = self.icg_op.embed()
-        with self.fig.batch_update():
-            self.fig.data[0].x = Y[:,0]
-            self.fig.data[0].y = Y[:,1]
-            self.fig.data[0].marker['size'] = node_sizes
-            self.fig.data[0].marker['sizeref'] = 2. * np.max(node_sizes) / (6 ** 2)
-            self.fig.data[0].selectedpoints = None
-            self.selected_idx = None
+        level_nodes = self.icg_op.level_nodes
+
+        def apply(result):
+            with profiling.stage("figure_update", n_nodes=len(result[1])), self.fig.batch_update():
+                self.Y, self.node_sizes = result
+                self.level_nodes = level_nodes
+                self.node_colors = None
+                self._draw()
+                self.fig.data[0].selectedpoints = None
+                self.selected_idx = None
+            self.prefetch_expansions()
+
+        self.run_in_background(
+            self.worker, "Embedding {} nodes...".format(self.icg_op.n_nodes(level_nodes)),
+            lambda: self.icg_op.embed(level_nodes=level_nodes, should_stop=self.worker.superseded),
+            apply, name="rebuild")
     
+    def prefetch_expansions(self):
+        """Embeds the expansion of each of the `prefetch` largest drawn nodes while idle."""
+        if self.prefetch <= 0:
+            return
+        level_nodes = self.level_nodes
+        self.prefetch_worker.submit_idle([
+            lambda idx=idx: self.icg_op.prefetch(np.array([idx]), level_nodes=level_nodes,
+                                                 should_stop=self.prefetch_worker.superseded)
+            for idx in self.icg_op.expansion_candidates(self.prefetch, level_nodes)
+        ], on_error=lambda err: None, name="prefetch")
+
     def rebuild_genes(self):
-        Y, gene_list, self.gene_idx = self.icg_op.embed_genes()
-        with self.gene_fig.batch_update():
-            self.gene_fig.data[0].x = Y[:,0]
-            self.gene_fig.data[0].y = Y[:,1]
-            self.gene_fig.data[0].text = gene_list
-            self.gene_fig.data[0].selectedpoints = None
+        level_nodes = self.icg_op.level_nodes
+
+        def apply(result):
+            Y, gene_list, self.gene_idx = result
+            with profiling.stage("gene_figure_update", n_genes=len(gene_list)), self.gene_fig.batch_update():
+                Y = Y.astype(np.float32)
+                self._update_trace(self.gene_fig.data[0], x=Y[:,0], y=Y[:,1], text=gene_list)
+                self.gene_fig.data[0].selectedpoints = None
+
+        self.run_in_background(
+            self.gene_worker, "Building gene graph...",
+            lambda: self.icg_op.embed_genes(level_nodes=level_nodes, should_stop=self.gene_worker.superseded),
+            apply, name="rebuild_genes")
     
-    def color_by_gene(self, gene_idx):
-        expression = scprep.utils.toarray(self.icg_op.gene_expression().tocsr()[self.gene_idx[gene_idx]].sum(axis=0)).flatten()
+    @staticmethod
+    def _scale_colors(expression):
+        expression = np.asarray(expression, dtype=np.float32).flatten()
         expression -= expression.min()
         expr_max = expression.max()
         if expr_max > 0:
             expression /= expr_max
-        colors = [mpl.colors.to_hex(c) for c in mpl.cm.inferno(expression)]
-        self.fig.data[0].marker.color = colors
+        return expression
+
+    def color_by_gene(self, gene_idx):
+        with profiling.stage("color_by_gene", n_selected=len(gene_idx)):
+            X = self.icg_op.gene_expression(self.level_nodes, format='csr')
+            self.node_colors = self._scale_colors(X[self.gene_idx[gene_idx]].sum(axis=0))
+            self._draw_colors()
     
-    def color_by_cluster(self, cell_idx):
-        expression = scprep.utils.toarray(self.icg_op.gene_expression().tocsc()[:,cell_idx].sum(axis=1)).flatten()
-        expression -= expression.min()
-        expr_max = expression.max()
-        if expr_max > 0:
-            expression /= expr_max
-        colors = [mpl.colors.to_hex(c) for c in mpl.cm.inferno(expression)]
-        self.gene_fig.data[0].marker.color = colors
+    def color_by_cluster(self, point_idx):
+        with profiling.stage("color_by_cluster", n_selected=len(point_idx)):
+            X = self.icg_op.gene_expression(self.level_nodes, format='csc')
+            self._update_trace(self.gene_fig.data[0],
+                               marker_color=self._scale_colors(X[:,self._members(point_idx)].sum(axis=1)))
 
-    def expand(self, zoom=False, filter=False):
+    def expand(self, zoom=False, filter=False, to_level=None):
         if self.selected_idx is None:
             print("Select points with the Lasso tool to expand.")
             return
         with self.lock() as lock_fn:
             lock_fn()
+            # the selection refers to the drawn nodes, even if a newer view is embedding
             if filter:
-                self.icg_op.remove(self.selected_idx)
+                self.icg_op.remove(self.selected_idx, level_nodes=self.level_nodes)
             else:
-                self.icg_op.refine(self.selected_idx, remove_deselected=zoom)
-
+                self.icg_op.refine(self.selected_idx, remove_deselected=zoom,
+                                   level_nodes=self.level_nodes, to_level=to_level)
+            self.selected_idx = None
             self.rebuild()
         
     def click_expand(self, b):
         self.expand()
 
+    def click_cells(self, b):
+        self.expand(to_level=0)
+
     def click_zoom(self, b):
         self.expand(zoom=True)
 
     def click_filter(self, b):
         self.expand(filter=True)
 
+    def click_back(self, b):
+        with self.lock() as lock_fn:
+            lock_fn()
+            if self.icg_op.back():
+                self.rebuild()
+
+    def click_forward(self, b):
+        with self.lock() as lock_fn:
+            lock_fn()
+            if self.icg_op.forward():
+                self.rebuild()
+
     def click_reset(self, b):
         with self.lock() as lock_fn:
             lock_fn()
@@ -144,12 +356,14 @@ class PlotlyDashboard():
     def click_genes_point(self, trace, points, selector):
         with self.lock() as lock_fn:
             lock_fn()
-            self.color_by_gene(points.point_inds)
+            with self.figure_lock:
+                self.color_by_gene(points.point_inds)
     
     def click_cells_point(self, trace, points, selector):
         with self.lock() as lock_fn:
             lock_fn()
-            self.color_by_cluster(points.point_inds)
+            with self.figure_lock:
+                self.color_by_cluster(points.point_inds)
         
     @property
     def dashboard(self):
@@ -160,9 +374,13 @@ class PlotlyDashboard():
             ]),
             widgets.HBox([
                 self.expand_button, 
+                self.cells_button,
                 self.zoom_button, 
                 self.filter_button, 
+                self.back_button,
+                self.forward_button,
                 self.reset_button,
                 self.genes_button,
-            ])
+            ]),
+            self.status,
         ])
\ No newline at end of file
@@ -3,15 +3,101 @@ import scprep
 import os
 import numpy as np
 import subprocess
+import hashlib
+import json
 
-def load_eb():
-    download_path = os.path.expanduser("~")
+from . import io
+
+CACHE_FORMAT_VERSION = 1
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "h_phate")
+
+PBMC_URL = "https://cf.10xgenomics.com/samples/cell-exp/2.1.0/pbmc4k/pbmc4k_filtered_gene_bc_matrices.tar.gz"
+EB_URL = ("https://md-datasets-public-files-prod.s3.eu-west-1.amazonaws.com/"
+          "5739738f-d4dd-49f7-b8d1-5841abdbeb1e")
+
+
+def _cache_path(cache_dir, name, **params):
+    key = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, "{}_{}".format(name, key))
+
+
+def save_cache(path, data):
+    """Saves a (sparse) DataFrame as a memory-mappable sparse matrix with labels."""
+    os.makedirs(path, exist_ok=True)
+    X = scprep.utils.to_array_or_spmatrix(data)
+    info = io.save_sparse(path, "data", X)
+    io.save_array(path, "cells", np.asarray(data.index, dtype=str))
+    io.save_array(path, "genes", np.asarray(data.columns, dtype=str))
+    # written last: a cache without a manifest is incomplete
+    io.write_manifest(path, dict(data=info), version=CACHE_FORMAT_VERSION)
+
+
+def load_cache(path, mmap_mode='r'):
+    """Loads a cache written by `save_cache`.
+
+    Returns
+    -------
+    X : sparse matrix, shape=[n_cells, n_genes]
+        memory-mapped unless `mmap_mode` is None
+    cells, genes : array-like
+        row and column labels of `X`
+    """
+    manifest = io.read_manifest(path, version=CACHE_FORMAT_VERSION)
+    X = io.load_sparse(path, "data", manifest['data'], mmap_mode=mmap_mode)
+    cells = io.load_array(path, "cells", mmap_mode=None)
+    genes = io.load_array(path, "genes", mmap_mode=None)
+    return X, cells, genes
+
+
+def _cached(load_fn, cache_dir, name, **params):
+    if cache_dir is None:
+        return load_fn()
+    path = _cache_path(cache_dir, name, **params)
+    try:
+        X, cells, genes = load_cache(path)
+        # the DataFrame copies the memory-mapped matrix: the cache saves
+        # preprocessing and parsing, not memory
+        return scprep.utils.SparseDataFrame(X, index=cells, columns=genes)
+    except (FileNotFoundError, ValueError):
+        pass
+    data = load_fn()
+    save_cache(path, data)
+    return data
+
+
+def load_eb(path=None, cache_dir=DEFAULT_CACHE_DIR, min_cells=10,
+            library_size_percentile=(20, 75), mito_percentile=90):
+    """Loads and normalizes the embryoid body dataset.
+
+    Parameters
+    ----------
+    path : str or None, optional (default: None)
+        Directory containing the extracted `scRNAseq` folder.
+        If None, uses the home directory and downloads the data if missing.
+    cache_dir : str or None, optional (default: ~/.cache/h_phate)
+        Directory for the preprocessed cache. If None, no cache is used.
+    min_cells : int, optional (default: 10)
+        Genes expressed in fewer cells are removed
+    library_size_percentile : tuple of int, optional (default: (20, 75))
+        Cells outside these library size percentiles are removed from each batch
+    mito_percentile : int, optional (default: 90)
+        Cells above this percentile of mitochondrial expression are removed
+    """
+    download_path = os.path.expanduser("~") if path is None else path
+    params = dict(min_cells=min_cells, library_size_percentile=list(library_size_percentile),
+                  mito_percentile=mito_percentile)
+    return _cached(lambda: _load_eb(download_path, download=path is None, **params), cache_dir, "eb",
+                   source=os.path.abspath(download_path), **params)
+
+
+def _load_eb(download_path, download=True, min_cells=10,
+             library_size_percentile=(20, 75), mito_percentile=90):
     if not os.path.isdir(os.path.join(download_path, "scRNAseq", "T0_1A")):
+        if not download:
+            raise FileNotFoundError(
+                "Expected extracted data at {}".format(os.path.join(download_path, "scRNAseq")))
         # need to download the data
-        scprep.io.download.download_and_extract_zip(
-            "https://md-datasets-public-files-prod.s3.eu-west-1.amazonaws.com/"
-            "5739738f-d4dd-49f7-b8d1-5841abdbeb1e",
-            download_path)
+        scprep.io.download.download_and_extract_zip(EB_URL, download_path)
     sparse=True
     T1 = scprep.io.load_10X(os.path.join(download_path, "scRNAseq", "T0_1A"), sparse=sparse, gene_labels='both')
     T2 = scprep.io.load_10X(os.path.join(download_path, "scRNAseq", "T2_3B"), sparse=sparse, gene_labels='both')
@@ -20,8 +106,8 @@ def load_eb():
     T5 = scprep.io.load_10X(os.path.join(download_path, "scRNAseq", "T8_9E"), sparse=sparse, gene_labels='both')
     filtered_batches = []
     for batch in [T1, T2, T3, T4, T5]:
-        batch = scprep.filter.filter_library_size(batch, percentile=20, keep_cells='above')
-        batch = scprep.filter.filter_library_size(batch, percentile=75, keep_cells='below')
+        batch = scprep.filter.filter_library_size(batch, percentile=library_size_percentile[0], keep_cells='above')
+        batch = scprep.filter.filter_library_size(batch, percentile=library_size_percentile[1], keep_cells='below')
         filtered_batches.append(batch)
     del T1, T2, T3, T4, T5 # removes objects from memory
     data, sample_labels = scprep.utils.combine_batches(
@@ -30,17 +116,40 @@ def load_eb():
     append_to_cell_names=True
 )
     del filtered_batches # removes objects from memory
-    data = scprep.filter.filter_rare_genes(data, min_cells=10)
+    data = scprep.filter.filter_rare_genes(data, min_cells=min_cells)
     data, sample_labels = scprep.filter.filter_gene_set_expression(
     data, sample_labels, starts_with="MT-", library_size_normalize=True,
-    percentile=90, keep_cells='below')
+    percentile=mito_percentile, keep_cells='below')
     return normalize(data)
 
-def load_pbmc():
-    scprep.io.download.download_url("https://cf.10xgenomics.com/samples/cell-exp/2.1.0/pbmc4k/pbmc4k_filtered_gene_bc_matrices.tar.gz", "pbmc4k_filtered_gene_bc_matrices.tar.gz")
-    subprocess.run(['tar', 'xzf', "pbmc4k_filtered_gene_bc_matrices.tar.gz"])
-    data = scprep.io.load_10X("filtered_gene_bc_matrices/GRCh38", gene_labels='both')
-    data = scprep.filter.remove_rare_genes(data, min_cells=5)
+def load_pbmc(path=None, cache_dir=DEFAULT_CACHE_DIR, min_cells=5):
+    """Loads and normalizes the 10X PBMC 4k dataset.
+
+    Parameters
+    ----------
+    path : str or None, optional (default: None)
+        Either the downloaded .tar.gz archive or the extracted 10X matrix
+        directory. If None, downloads the archive to the working directory.
+    cache_dir : str or None, optional (default: ~/.cache/h_phate)
+        Directory for the preprocessed cache. If None, no cache is used.
+    min_cells : int, optional (default: 5)
+        Genes expressed in fewer cells are removed
+    """
+    source = PBMC_URL if path is None else os.path.abspath(path)
+    return _cached(lambda: _load_pbmc(path, min_cells=min_cells), cache_dir, "pbmc",
+                   source=source, min_cells=min_cells)
+
+
+def _load_pbmc(path=None, min_cells=5):
+    if path is None:
+        path = "pbmc4k_filtered_gene_bc_matrices.tar.gz"
+        scprep.io.download.download_url(PBMC_URL, path)
+    if os.path.isfile(path):
+        extract_path = os.path.dirname(os.path.abspath(path))
+        subprocess.run(['tar', 'xzf', path, '-C', extract_path])
+        path = os.path.join(extract_path, "filtered_gene_bc_matrices", "GRCh38")
+    data = scprep.io.load_10X(path, gene_labels='both')
+    data = scprep.filter.remove_rare_genes(data, min_cells=min_cells)
     data = scprep.filter.remove_empty_cells(data)
     return normalize(data)
 
@@ -48,4 +157,4 @@ def normalize(data):
     data = scprep.normalize.library_size_normalize(data)
     data = scprep.transform.sqrt(data)
     data = scprep.transform.arcsinh(data)
-    return data
\ No newline at end of file
+    return data
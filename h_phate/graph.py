@@ -1,16 +1,215 @@
 import graphtools
+import pandas as pd
 import scprep
 import graph_coarsening
+import hashlib
 import numpy as np
+import os
 from scipy import sparse
 
+from . import io, profiling
+from .hierarchy import HierarchyIndex
+from .utils import LRUCache, PatchableSparse, append, nbytes
+
+
+def _compact(X):
+    """float32 values and int32 indices, or int32 for an index array."""
+    if not sparse.issparse(X):
+        return np.asarray(X).astype(np.int32)
+    X = X.astype(np.float32)
+    if X.nnz < 2**31 and max(X.shape) < 2**31:
+        X.indices = X.indices.astype(np.int32)
+        X.indptr = X.indptr.astype(np.int32)
+    return X
+
+
+def _csr(X):
+    return X if isinstance(X, PatchableSparse) else sparse.csr_matrix(X)
+
+
+def _unpatched(X):
+    return X.tosparse() if isinstance(X, PatchableSparse) else X
+
+
+def _digest(nodes):
+    if nodes is None:
+        return None
+    return hashlib.sha1(np.ascontiguousarray(nodes)).digest()
+
+
+class LazyAdjacency:
+    """Cross-level adjacency blocks computed on demand.
+
+    The block between levels `to_level` and `from_level <= to_level` is
+    `coarseners[to_level-1] @ ... @ coarseners[from_level] @ W[from_level]`.
+    Blocks are restricted to the requested rows and columns before being
+    multiplied and are kept in an LRU cache bounded by `cache_bytes`.
+
+    Parameters
+    ----------
+    W : list of sparse matrices
+        adjacency matrix of each level
+    coarseners : list of sparse matrices
+        coarseners[i] maps level i to level i + 1
+    cache_bytes : int
+        memory budget for cached blocks
+    """
+
+    def __init__(self, W, coarseners, cache_bytes=2**28):
+        self.W = [_csr(w) for w in W]
+        self.coarseners = [_csr(c) for c in coarseners]
+        self.n_levels = len(self.W)
+        self.cache = LRUCache(cache_bytes)
+
+    def set_level(self, level, W, coarsener=None):
+        """Replaces the adjacency and coarsener of `level` and evicts the cached blocks that use them.
+
+        Block `(to_level, from_level)` uses `W[from_level]` and
+        `coarseners[from_level:to_level]`.
+        """
+        self.W[level] = _csr(W)
+        if coarsener is not None:
+            self.coarseners[level] = _csr(coarsener)
+        self.cache.evict(lambda key: key[1] == level or
+                         (coarsener is not None and key[1] <= level < key[0]))
+
+    def keys(self):
+        return [(to_level, from_level) for to_level in range(self.n_levels)
+                for from_level in range(to_level + 1)]
+
+    def __getitem__(self, key):
+        to_level, from_level = key
+        return self.submatrix(to_level, from_level)
+
+    def submatrix(self, to_level, from_level, rows=None, cols=None):
+        """Returns the block from `from_level` to `to_level` restricted to `rows` and `cols`."""
+        if from_level > to_level:
+            raise ValueError("Expected from_level <= to_level. "
+                             "Got from_level={}, to_level={}".format(from_level, to_level))
+        if to_level == from_level:
+            A = self.W[to_level]
+            if rows is not None:
+                A = A[rows]
+            if cols is not None:
+                A = A[:,cols]
+            return A
+        key = (to_level, from_level, _digest(rows), _digest(cols))
+        try:
+            return self.cache[key]
+        except KeyError:
+            pass
+        with profiling.stage("adjacency_block", to_level=to_level, from_level=from_level) as stage:
+            coarsener = self.coarseners[to_level-1]
+            if rows is not None:
+                coarsener = coarsener[rows]
+            for level in range(to_level-2, from_level-1, -1):
+                coarsener = coarsener @ self.coarseners[level]
+            A = coarsener @ self.W[from_level]
+            if cols is not None:
+                A = A[:,cols]
+            A = A.tocsr()
+            stage.update(shape=A.shape, nnz=A.nnz)
+        self.cache[key] = A
+        return A
+
+
 class CoarseGraph:
-    def __init__(self, K=10, r=0.9, method='variation_edges', algorithm='greedy', hvg_percentile=90):
+    def __init__(self, K=10, r=0.9, method='variation_edges', algorithm='greedy', hvg_percentile=90,
+                 size_weighted_expression=False, adjacency_cache_bytes=2**28,
+                 n_pca=100, knn=5, decay=40, knn_backend='exact', n_jobs=-1, random_state=None,
+                 gene_knn=None, compact=False):
         self.K = K
         self.r = r
         self.method = method
         self.algorithm = algorithm
         self.hvg_percentile = hvg_percentile
+        self.size_weighted_expression = size_weighted_expression
+        self.adjacency_cache_bytes = adjacency_cache_bytes
+        self.n_pca = n_pca
+        self.knn = knn
+        self.decay = decay
+        self.knn_backend = knn_backend
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+        self.gene_knn = gene_knn
+        self.compact = compact
+        # directory this hierarchy was loaded from, if any
+        self.path = None
+        self._hierarchy = None
+
+    @property
+    def hierarchy(self):
+        """`HierarchyIndex` of the hierarchy, rebuilt on first use after `extend`."""
+        if self._hierarchy is None:
+            self._hierarchy = HierarchyIndex(self.parents, self.level_sizes)
+        return self._hierarchy
+
+    def _reduce_dimensions(self, data):
+        """Randomized PCA, or truncated SVD if `data` is sparse so it is never densified."""
+        from sklearn.decomposition import PCA, TruncatedSVD
+        self.pca_op = None
+        if self.n_pca is None or self.n_pca >= min(data.shape):
+            return scprep.utils.toarray(data)
+        if sparse.issparse(data):
+            self.pca_op = TruncatedSVD(self.n_pca, algorithm='randomized',
+                                       random_state=self.random_state)
+        else:
+            self.pca_op = PCA(self.n_pca, svd_solver='randomized',
+                              random_state=self.random_state)
+        return self.pca_op.fit_transform(data)
+
+    def _build_approximate_graph(self, data, thresh=1e-4, search_multiplier=3):
+        """Alpha-decay kNN graph over approximate nearest neighbors from pynndescent."""
+        try:
+            import pynndescent
+        except ImportError:
+            raise ImportError("knn_backend='pynndescent' requires pynndescent. "
+                              "Install it with `pip install pynndescent`.")
+        data_pca = self._reduce_dimensions(data)
+        n_neighbors = min(search_multiplier * self.knn, data_pca.shape[0])
+        index = pynndescent.NNDescent(
+            data_pca, n_neighbors=n_neighbors, n_jobs=self.n_jobs,
+            random_state=self.random_state)
+        indices, distances = index.neighbor_graph
+        self._knn_index = index
+        # each point is its own first neighbor, so the knn-th neighbor is column `knn`
+        K = self._alpha_decay_kernel(indices, distances, data_pca.shape[0], self.knn, thresh=thresh)
+        K = (K + K.T) / 2
+        return graphtools.Graph(K, precomputed='affinity', use_pygsp=True, n_jobs=self.n_jobs)
+
+    def _alpha_decay_kernel(self, indices, distances, n_cols, bandwidth_column, thresh=1e-4):
+        """Alpha-decay affinities to the neighbors `indices`, with `distances[:,bandwidth_column]` as bandwidth."""
+        bandwidth = distances[:,bandwidth_column].copy()
+        bandwidth[bandwidth == 0] = np.finfo(float).eps
+        affinity = np.exp(-(distances / bandwidth[:,None]) ** self.decay)
+        affinity[affinity < thresh] = 0
+        K = sparse.csr_matrix((affinity.flatten(), (np.repeat(np.arange(indices.shape[0]), indices.shape[1]),
+                                                    indices.flatten())),
+                              shape=(indices.shape[0], n_cols))
+        K.eliminate_zeros()
+        return K
+
+    def _kernel_to_data(self, data, search_multiplier=3):
+        """Affinities from new cells to the cells the graph was fitted on."""
+        if self.knn_backend == 'pynndescent':
+            data_pca = scprep.utils.toarray(data) if self.pca_op is None else self.pca_op.transform(data)
+            indices, distances = self._knn_index.query(
+                data_pca, k=min(search_multiplier * self.knn, self.graphs[0].N))
+            # new cells are not in the index, so the knn-th neighbor is column `knn - 1`
+            return self._alpha_decay_kernel(indices, distances, self.graphs[0].N, self.knn - 1)
+        return sparse.csr_matrix(self.graphs[0].build_kernel_to_data(data))
+
+    def _build_graph(self, data):
+        data = scprep.utils.to_array_or_spmatrix(data)
+        if self.knn_backend == 'exact':
+            return graphtools.Graph(data, n_pca=self.n_pca, knn=self.knn, decay=self.decay,
+                                    n_jobs=self.n_jobs, random_state=self.random_state,
+                                    use_pygsp=True)
+        elif self.knn_backend == 'pynndescent':
+            return self._build_approximate_graph(data)
+        else:
+            raise ValueError("Expected knn_backend in ['exact', 'pynndescent']. "
+                             "Got {}".format(self.knn_backend))
         
     def _build_map_refine(self, map_coarsen):
         """Builds the map from a coarse level to a fine level.
@@ -26,14 +225,20 @@ class CoarseGraph:
             coarsener = self.map_coarsen[(i, i+1)]
             try:
                 max_coarsening = coarsener.shape[1]
-            except AttributeError:
-                max_coarsening = np.max([len(c) for c in coarsener])
-                coarsener = np.array([np.concatenate([c, np.repeat(-1, max_coarsening-len(c))]) for c in coarsener])
+            except (AttributeError, IndexError):
+                # ragged groups: scatter them into a -1 padded array
+                lengths = np.fromiter(map(len, coarsener), dtype=int, count=len(coarsener))
+                max_coarsening = lengths.max()
+                starts = np.cumsum(lengths) - lengths
+                padded = np.full((len(coarsener), max_coarsening), -1)
+                padded[np.repeat(np.arange(len(coarsener)), lengths),
+                       np.arange(lengths.sum()) - np.repeat(starts, lengths)] = np.concatenate(coarsener)
+                coarsener = padded
 
             first_nodes = coarsener[:,0]
             remaining_nodes = coarsener[:,1:]
             coarsener = coarsener[np.argsort(first_nodes)]
-            nodes_deleted = np.unique(np.concatenate(remaining_nodes))
+            nodes_deleted = np.unique(remaining_nodes)
             nodes_retained = np.setdiff1d(np.arange(self.level_sizes[i]), nodes_deleted)
             refiner = np.full((len(nodes_retained), max_coarsening), -1)
             refiner[np.arange(len(nodes_retained)),0] = nodes_retained
@@ -41,62 +246,442 @@ class CoarseGraph:
             map_refine[(i+1, i)] = refiner
         return map_refine
     
+    def _build_parents(self):
+        """Builds the map from a fine level to a coarse level.
+
+        Returns
+        -------
+        parents : dict
+            parents[i][j] gives the index in level i + 1 that
+            index j in level i maps to
+        """
+        parents = dict()
+        for i in range(self.n_levels-1):
+            map_refine = self.map_refine[(i+1, i)]
+            merged = map_refine != -1
+            parents[i] = np.full(self.level_sizes[i], -1)
+            parents[i][map_refine[merged]] = np.nonzero(merged)[0]
+        return parents
+
     def _build_node_sizes(self):
+        """Number of cells under each node, summed over every merged node of a group."""
         node_sizes = dict()
         node_sizes[0] = np.ones(self.level_sizes[0])
         for i in range(1, self.n_levels):
             map_refine = self.map_refine[(i, i-1)]
-            node_sizes[i] = node_sizes[i-1][map_refine[:,0]]
-            expand_idx = map_refine[:,1] != -1
-            node_sizes[i][expand_idx] += node_sizes[i-1][map_refine[expand_idx,1]]
+            merged = map_refine != -1
+            node_sizes[i] = np.zeros(self.level_sizes[i])
+            np.add.at(node_sizes[i], np.nonzero(merged)[0], node_sizes[i-1][map_refine[merged]])
         return node_sizes
     
+    def _build_pooling(self, level, nodes=None):
+        """Builds the operator averaging level - 1 nodes into their level nodes.
+
+        Parameters
+        ----------
+        level : int
+        nodes : array-like or None, optional (default: None)
+            If given, only builds the rows of these level nodes
+
+        Returns
+        -------
+        pooling : sparse matrix, shape=[level_sizes[level], level_sizes[level-1]]
+            each row holds the weights of the merged nodes. Weights are equal
+            unless `size_weighted_expression` is set, in which case they are
+            proportional to `node_sizes[level-1]`.
+        """
+        map_refine = self.map_refine[(level, level-1)]
+        if nodes is None:
+            nodes = np.arange(self.level_sizes[level])
+        map_refine = map_refine[nodes]
+        merged = map_refine != -1
+        rows = np.nonzero(merged)[0]
+        children = map_refine[merged]
+        if self.size_weighted_expression:
+            weights = self.node_sizes[level-1][children] / self.node_sizes[level][nodes[rows]]
+        else:
+            weights = 1 / np.sum(merged, axis=1)[rows]
+        return sparse.csr_matrix((weights, (rows, children)),
+                                 shape=(len(nodes), self.level_sizes[level-1]))
+
     def _build_gene_expression(self):
         gene_expression = dict()
-        data_hvg = scprep.select.highly_variable_genes(self.data, percentile=self.hvg_percentile)
-        self.gene_list = data_hvg.columns.to_numpy()
-        gene_expression[0] = sparse.lil_matrix(scprep.utils.to_array_or_spmatrix(data_hvg))
+        data_hvg, self._hvg_idx = scprep.select.highly_variable_genes(
+            self.data, np.arange(self.data.shape[1]), percentile=self.hvg_percentile)
+        self.gene_list = (self.data.columns[self._hvg_idx].to_numpy()
+                          if isinstance(self.data, pd.DataFrame) else self._hvg_idx)
+        gene_expression[0] = sparse.csr_matrix(scprep.utils.to_array_or_spmatrix(data_hvg))
         for i in range(1, self.n_levels):
-            map_refine = self.map_refine[(i, i-1)]
-            gene_expression[i] = gene_expression[i-1][map_refine[:,0]]
-            expand_idx = map_refine[:,1] != -1
-            gene_expression[i][expand_idx] += gene_expression[i-1][map_refine[expand_idx,1]]
-            gene_expression[i][expand_idx] /= 2
+            gene_expression[i] = self._build_pooling(i) @ gene_expression[i-1]
 
+        # per-gene normalization factors, kept so `extend` can add nodes without renormalizing
+        self._gene_scale = dict()
         for i in gene_expression:
-            gene_expression[i] = gene_expression[i].tocsr().T
+            gene_expression[i] = gene_expression[i].T
+            gene_sums = np.asarray(gene_expression[i].sum(axis=1)).flatten()
             gene_expression[i] = scprep.normalize.library_size_normalize(gene_expression[i])
+            normalized_sums = np.asarray(gene_expression[i].sum(axis=1)).flatten()
+            self._gene_scale[i] = np.divide(normalized_sums, gene_sums,
+                                            out=np.zeros_like(gene_sums), where=gene_sums > 0)
         
         return gene_expression
     
+    def _build_gene_neighbors(self):
+        """Candidate gene neighbors over the nodes of each level.
+
+        `InteractiveCoarseGraph` recomputes the affinities between these
+        candidates from the expression in the visible nodes instead of
+        searching for gene neighbors in every view.
+
+        Returns
+        -------
+        gene_neighbors : dict
+            gene_neighbors[i][g] gives gene g followed by its `3 * gene_knn`
+            nearest genes over the nodes of level i
+        """
+        from sklearn.decomposition import TruncatedSVD
+        from sklearn.neighbors import NearestNeighbors
+        n_genes = len(self.gene_list)
+        genes = np.arange(n_genes)
+        n_neighbors = min(3 * self.gene_knn, n_genes - 1)
+        gene_neighbors = dict()
+        for i in range(self.n_levels):
+            X = self.gene_expression[i]
+            if self.n_pca is not None and self.n_pca < min(X.shape):
+                X = TruncatedSVD(self.n_pca, algorithm='randomized',
+                                 random_state=self.random_state).fit_transform(X)
+            else:
+                X = scprep.utils.toarray(X)
+            indices = NearestNeighbors(n_neighbors=n_neighbors + 1, n_jobs=self.n_jobs).fit(X).kneighbors(
+                X, return_distance=False)
+            # drop each gene from its own list, even when duplicates tie with it, and put it first
+            indices = np.take_along_axis(indices, np.argsort(indices == genes[:,None], axis=1, kind='stable'), axis=1)
+            gene_neighbors[i] = np.column_stack([genes, indices[:,:n_neighbors]])
+        return gene_neighbors
+
     def _build_adjacencies(self):
-        A = dict()
-        for level in range(self.n_levels):
-            G = self.graphs[level]
-            A[(level, level)] = G.W
-            if level > 0:
-                coarsener = self.coarseners[level-1]
-                for from_level in range(0, level):
-                    A[(level, from_level)] = coarsener @ A[(level-1, from_level)]
-                    if level == from_level:
-                        A[(level, from_level)] = graphtools.matrix.set_diagonal(A[(level, from_level)], 1)
-        return A
+        return LazyAdjacency([G.W for G in self.graphs], self.coarseners,
+                             cache_bytes=self.adjacency_cache_bytes)
         
     def fit(self, data):
-        self.data = data
-        G = graphtools.Graph(data, n_pca=100, use_pygsp=True)
-        _, _, self.coarseners, self.graphs, hierarchy = graph_coarsening.coarsen(
-            G, K=self.K, r=self.r, method=self.method, algorithm=self.algorithm
-        )
-        self.n_levels = len(self.graphs)
-        self.level_sizes = [G.N for G in self.graphs] # largest to smallest
-        self.map_coarsen = {(i, i+1) : h for i, h in enumerate(hierarchy)}
-        self.map_refine = self._build_map_refine(self.map_coarsen)
-        self.node_sizes = self._build_node_sizes()
-        self.gene_expression = self._build_gene_expression()
-        self.adjacency = self._build_adjacencies()
+        with profiling.stage("fit", n_cells=data.shape[0], n_genes=data.shape[1]):
+            self.data = data
+            with profiling.stage("build_graph") as stage:
+                G = self._build_graph(data)
+                stage.update(nnz=G.W.nnz)
+            with profiling.stage("coarsen") as stage:
+                _, _, self.coarseners, self.graphs, hierarchy = graph_coarsening.coarsen(
+                    G, K=self.K, r=self.r, method=self.method, algorithm=self.algorithm
+                )
+                stage.update(n_levels=len(self.graphs))
+            self.n_levels = len(self.graphs)
+            self.level_sizes = [G.N for G in self.graphs] # largest to smallest
+            self.map_coarsen = {(i, i+1) : h for i, h in enumerate(hierarchy)}
+            with profiling.stage("build_map_refine"):
+                self.map_refine = self._build_map_refine(self.map_coarsen)
+            with profiling.stage("build_hierarchy"):
+                self.parents = self._build_parents()
+                self._hierarchy = HierarchyIndex(self.parents, self.level_sizes)
+            with profiling.stage("build_node_sizes"):
+                self.node_sizes = self._build_node_sizes()
+            with profiling.stage("build_gene_expression") as stage:
+                self.gene_expression = self._build_gene_expression()
+                stage.update(n_genes=len(self.gene_list),
+                             nnz=sum(X.nnz for X in self.gene_expression.values()))
+            self.gene_neighbors = None
+            if self.gene_knn is not None:
+                with profiling.stage("build_gene_neighbors"):
+                    self.gene_neighbors = self._build_gene_neighbors()
+            with profiling.stage("build_adjacencies"):
+                self.adjacency = self._build_adjacencies()
+            if self.compact:
+                with profiling.stage("compact"):
+                    self._compact()
+        return self
+
+    def extend(self, new_data):
+        """Inserts new cells into the fitted hierarchy without refitting it.
+
+        Each new cell is projected with the fitted PCA and kNN structures and
+        becomes a level 0 node merged into the level 1 node of its nearest
+        fitted cell. Node sizes, the gene expression of its ancestors and the
+        level 0 adjacency and coarsener are updated; the adjacency of coarser
+        levels, the candidate gene neighbors and the normalization factors are kept
+        from the fit. Later batches attach to the fitted cells only. Cached
+        adjacency blocks that use level 0 are evicted, the others are kept.
+
+        The updated matrices are converted to `PatchableSparse` on the first
+        call, so that later calls only write the rows and columns of the new
+        cells and their ancestors. The hierarchy index is rebuilt on first use.
+
+        Views of an `InteractiveCoarseGraph` created before `extend` do not
+        include the new cells; create a new one.
+
+        Parameters
+        ----------
+        new_data : array-like, shape=[n_new_cells, n_genes]
+            normalized like the fitted data, with the same genes
+
+        Returns
+        -------
+        self : CoarseGraph
+        """
+        if self.graphs is None:
+            raise ValueError("Cannot extend a hierarchy without its fitted graphs. "
+                             "Loaded and compact hierarchies cannot be extended.")
+        if new_data.shape[1] != self.data.shape[1]:
+            raise ValueError("Expected new_data to have {} genes. Got {}".format(
+                self.data.shape[1], new_data.shape[1]))
+        if (isinstance(new_data, pd.DataFrame) and isinstance(self.data, pd.DataFrame)
+                and list(new_data.columns) != list(self.data.columns)):
+            raise ValueError("Expected new_data to have the same genes as the fitted data")
+        n_new = new_data.shape[0]
+        n_old = self.level_sizes[0]
+        new_nodes = np.arange(n_old, n_old + n_new)
+        with profiling.stage("extend", n_cells=n_new):
+            with profiling.stage("kernel_to_data") as stage:
+                K = self._kernel_to_data(scprep.utils.to_array_or_spmatrix(new_data))
+                K = sparse.csr_matrix((K.data, K.indices, K.indptr), shape=(n_new, n_old))
+                stage.update(nnz=K.nnz)
+            nearest = np.asarray(K.argmax(axis=1)).flatten()
+            parents = self.parents[0][nearest]
+            with profiling.stage("attach"):
+                ancestors = self._attach(new_nodes, parents)
+                self._hierarchy = None
+            with profiling.stage("extend_adjacency"):
+                n = n_old + n_new
+                # the fitted cells adjacent to new cells gain columns, the new cells are new rows
+                W = self.adjacency.W[0]
+                W = W if isinstance(W, PatchableSparse) else PatchableSparse(W)
+                W.pad(n)
+                K = K.tocoo()
+                touched = np.unique(K.col)
+                W.set(touched, W[touched] + sparse.csr_matrix(
+                    (K.data, (np.searchsorted(touched, K.col), K.row + n_old)), shape=(len(touched), n)))
+                W.append(sparse.csr_matrix((K.data, (K.row, K.col)), shape=(n_new, n)))
+                # each new cell enters the row of its parent with the weight of its nearest cell
+                coarsener = self.coarseners[0]
+                coarsener = coarsener if isinstance(coarsener, PatchableSparse) else PatchableSparse(coarsener)
+                coarsener.pad(n)
+                groups, local = np.unique(parents, return_inverse=True)
+                rows = coarsener[groups]
+                weights = np.asarray(rows[local, nearest]).flatten()
+                coarsener.set(groups, rows + sparse.csr_matrix(
+                    (weights, (local, new_nodes)), shape=(len(groups), n)))
+                self.coarseners = [coarsener] + self.coarseners[1:]
+                self.adjacency.set_level(0, W, coarsener)
+            with profiling.stage("extend_gene_expression"):
+                self.gene_expression = {
+                    i: X if isinstance(X, PatchableSparse) else PatchableSparse(X, axis=1)
+                    for i, X in self.gene_expression.items()}
+                X = scprep.utils.to_array_or_spmatrix(scprep.select.select_cols(new_data, idx=self._hvg_idx))
+                X = sparse.csc_matrix(X.T).multiply(self._gene_scale[0][:,None])
+                self.gene_expression[0].append(X)
+                for level in range(1, self.n_levels):
+                    self._update_gene_expression(level, ancestors[level])
+        self.path = None
         return self
+
+    def _attach(self, nodes, parents):
+        """Merges new level 0 `nodes` into the level 1 `parents`.
+
+        Returns
+        -------
+        ancestors : dict
+            ancestors[i] gives the unique level i ancestors of `nodes`
+        """
+        refiner = self.map_refine[(1, 0)]
+        order = np.argsort(parents, kind='stable')
+        sorted_parents = parents[order]
+        rank = np.arange(len(nodes)) - np.searchsorted(sorted_parents, sorted_parents)
+        slots = np.empty(len(nodes), dtype=int)
+        slots[order] = np.sum(refiner[sorted_parents] != -1, axis=1) + rank
+        if slots.max() >= refiner.shape[1]:
+            # widened to at least twice the width so that growing groups rarely copy it
+            width = max(slots.max() + 1, 2 * refiner.shape[1])
+            refiner = np.hstack([refiner, np.full((refiner.shape[0], width - refiner.shape[1]), -1)])
+        refiner[parents, slots] = nodes
+        self.map_refine[(1, 0)] = refiner
+        self.parents[0] = append(self.parents[0], parents)
+        self.level_sizes[0] += len(nodes)
+        self.node_sizes[0] = append(self.node_sizes[0], np.ones(len(nodes)))
+        ancestors = {0: nodes}
+        cell_ancestors = parents
+        for level in range(1, self.n_levels):
+            np.add.at(self.node_sizes[level], cell_ancestors, 1)
+            ancestors[level] = np.unique(cell_ancestors)
+            if level < self.n_levels - 1:
+                cell_ancestors = self.parents[level][cell_ancestors]
+        return ancestors
+
+    def _update_gene_expression(self, level, nodes):
+        """Pools the expression of `nodes` again from their children at level - 1."""
+        pooling = self._build_pooling(level, nodes)
+        children = np.unique(pooling.indices)
+        previous = self.gene_expression[level-1][:,children]
+        previous = previous.multiply(np.divide(
+            1, self._gene_scale[level-1], out=np.zeros_like(self._gene_scale[level-1]),
+            where=self._gene_scale[level-1] > 0)[:,None])
+        pooled = previous @ pooling[:,children].T
+        self.gene_expression[level].set(nodes, pooled.multiply(self._gene_scale[level][:,None]))
+
+    def _compact(self):
+        """Stores values as float32, indices as int32 and node sizes as integer counts.
+
+        The fitted graphs are released, as in a loaded hierarchy: their
+        adjacency matrices cannot be converted in place.
+        """
+        self.graphs = None
+        self.node_sizes = {i: np.rint(n).astype(np.int32) for i, n in self.node_sizes.items()}
+        self.map_refine = {key: _compact(m) for key, m in self.map_refine.items()}
+        self.parents = {i: _compact(p) for i, p in self.parents.items()}
+        self._hierarchy = HierarchyIndex(self.parents, self.level_sizes)
+        self.gene_expression = {i: _compact(X) for i, X in self.gene_expression.items()}
+        if self.gene_neighbors is not None:
+            self.gene_neighbors = {i: _compact(n) for i, n in self.gene_neighbors.items()}
+        self.coarseners = [_compact(C) for C in self.coarseners]
+        self.adjacency = LazyAdjacency([_compact(W) for W in self.adjacency.W], self.coarseners,
+                                       cache_bytes=self.adjacency_cache_bytes)
+
+    def memory_report(self):
+        """Bytes held by each structure of the hierarchy, per level.
+
+        Arrays shared between structures are counted once, and memory-mapped
+        arrays are counted at their full size.
+
+        Returns
+        -------
+        report : pd.DataFrame
+            one row per structure, one column per level and a `total`
+            column and row. Structures that are not split by level, such as
+            the input data and the fitted graphs, only have a total.
+        """
+        seen = set()
+        levels = dict()
+
+        def add(structure, level, obj):
+            levels.setdefault(structure, dict())[level] = nbytes(obj, seen)
+
+        for i in range(self.n_levels):
+            add("adjacency", i, self.adjacency.W[i])
+            add("gene_expression", i, self.gene_expression[i])
+            if self.gene_neighbors is not None:
+                add("gene_neighbors", i, self.gene_neighbors[i])
+            add("node_sizes", i, self.node_sizes[i])
+            if i > 0:
+                add("coarsener", i, self.coarseners[i-1])
+                add("map_refine", i, self.map_refine[(i, i-1)])
+            if i < self.n_levels - 1:
+                add("parents", i, self.parents[i])
+            add("hierarchy", i, [self.hierarchy.order[i], self.hierarchy.position[i]] +
+                ([self.hierarchy.child_offsets[i]] if i > 0 else []))
+        report = pd.DataFrame.from_dict(levels, orient='index', dtype=float)
+        report = report.reindex(columns=range(self.n_levels)).fillna(0).astype(int)
+        report['total'] = report.sum(axis=1)
+        totals = dict(adjacency_cache=self.adjacency.cache.nbytes)
+        if self.graphs is not None:
+            totals['graphs'] = nbytes([G.W for G in self.graphs], seen)
+        if self.data is not None:
+            totals['data'] = (int(self.data.memory_usage(deep=True).sum())
+                              if isinstance(self.data, pd.DataFrame) else nbytes(self.data, seen))
+        for structure, total in totals.items():
+            report.loc[structure] = 0
+            report.loc[structure, 'total'] = total
+        report.loc['total'] = report.sum()
+        return report
     
+    def save(self, path):
+        """Saves the fitted hierarchy to a directory.
+
+        Sparse matrices and index arrays are written as separate .npy files
+        so that `CoarseGraph.load` can memory-map them. A `random_state`
+        that is not an int or None, e.g. a `np.random.RandomState`, cannot
+        be written to the manifest and is saved as None.
+
+        Parameters
+        ----------
+        path : str
+            Directory to write to. Created if it does not exist.
+        """
+        os.makedirs(path, exist_ok=True)
+        matrices = dict()
+        for i in range(self.n_levels):
+            io.save_array(path, "node_sizes_{}".format(i), self.node_sizes[i])
+            matrices["gene_expression_{}".format(i)] = io.save_sparse(
+                path, "gene_expression_{}".format(i), _unpatched(self.gene_expression[i]))
+            matrices["adjacency_{}".format(i)] = io.save_sparse(
+                path, "adjacency_{}".format(i), _unpatched(self.adjacency.W[i]))
+            if i > 0:
+                io.save_array(path, "map_refine_{}".format(i), self.map_refine[(i, i-1)])
+                matrices["coarsener_{}".format(i-1)] = io.save_sparse(
+                    path, "coarsener_{}".format(i-1), _unpatched(self.coarseners[i-1]))
+            if self.gene_neighbors is not None:
+                io.save_array(path, "gene_neighbors_{}".format(i), self.gene_neighbors[i])
+        io.write_manifest(path, dict(
+            params=dict(K=self.K, r=self.r, method=self.method,
+                        algorithm=self.algorithm, hvg_percentile=self.hvg_percentile,
+                        size_weighted_expression=self.size_weighted_expression,
+                        adjacency_cache_bytes=self.adjacency_cache_bytes,
+                        n_pca=self.n_pca, knn=self.knn, decay=self.decay,
+                        knn_backend=self.knn_backend, n_jobs=self.n_jobs,
+                        random_state=(int(self.random_state)
+                                      if isinstance(self.random_state, (int, np.integer)) else None),
+                        gene_knn=self.gene_knn,
+                        compact=self.compact),
+            n_levels=self.n_levels,
+            level_sizes=[int(n) for n in self.level_sizes],
+            gene_list=[str(g) for g in self.gene_list],
+            matrices=matrices,
+        ))
+        return self
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Loads a hierarchy written by `CoarseGraph.save`.
+
+        Parameters
+        ----------
+        path : str
+            Directory written by `CoarseGraph.save`
+        mmap_mode : {'r', 'c', None}, optional (default: 'r')
+            Passed to `np.load`. With 'r', arrays are memory-mapped read-only
+            and shared between processes that load the same hierarchy.
+
+        Returns
+        -------
+        cg_op : CoarseGraph
+        """
+        manifest = io.read_manifest(path)
+        matrices = manifest['matrices']
+        cg_op = cls(**manifest['params'])
+        cg_op.data = None
+        cg_op.graphs = None
+        cg_op.n_levels = manifest['n_levels']
+        cg_op.level_sizes = manifest['level_sizes']
+        cg_op.gene_list = np.array(manifest['gene_list'], dtype=object)
+        cg_op.node_sizes = dict()
+        cg_op.gene_expression = dict()
+        cg_op.map_refine = dict()
+        cg_op.coarseners = []
+        cg_op.gene_neighbors = dict() if manifest['params']['gene_knn'] is not None else None
+        for i in range(cg_op.n_levels):
+            cg_op.node_sizes[i] = io.load_array(path, "node_sizes_{}".format(i), mmap_mode)
+            name = "gene_expression_{}".format(i)
+            cg_op.gene_expression[i] = io.load_sparse(path, name, matrices[name], mmap_mode)
+            if i > 0:
+                cg_op.map_refine[(i, i-1)] = io.load_array(path, "map_refine_{}".format(i), mmap_mode)
+                name = "coarsener_{}".format(i-1)
+                cg_op.coarseners.append(io.load_sparse(path, name, matrices[name], mmap_mode))
+            if cg_op.gene_neighbors is not None:
+                cg_op.gene_neighbors[i] = io.load_array(path, "gene_neighbors_{}".format(i), mmap_mode)
+        W = [io.load_sparse(path, "adjacency_{}".format(i), matrices["adjacency_{}".format(i)], mmap_mode)
+             for i in range(cg_op.n_levels)]
+        cg_op.adjacency = LazyAdjacency(W, cg_op.coarseners, cache_bytes=cg_op.adjacency_cache_bytes)
+        cg_op.parents = cg_op._build_parents()
+        cg_op._hierarchy = HierarchyIndex(cg_op.parents, cg_op.level_sizes)
+        cg_op.path = path
+        return cg_op
+
     def create_nodes_dict(self, initialized=False):
         level_nodes = [np.array([], dtype=int)
                             for i in range(self.n_levels)]
@@ -105,13 +690,11 @@ class CoarseGraph:
         return level_nodes
     
     def refine_level(self, nodes, level):
-        refined_nodes = self.map_refine[level, level-1][nodes]
-        refined_nodes = np.setdiff1d(refined_nodes, [-1])
-        return refined_nodes
+        return np.sort(self.hierarchy.children(level, nodes))
     
     def refine(self, level_nodes):
         refined_level_nodes = self.create_nodes_dict()
         for i in range(1, self.n_levels):
             refined_level_nodes[i-1] = self.refine_level(level_nodes[i], i)
         refined_level_nodes[0] = np.union1d(refined_level_nodes[0], level_nodes[0])
-        return refined_level_nodes
\ No newline at end of file
+        return refined_level_nodes
@@ -1,20 +1,56 @@
 from .graph import CoarseGraph
 from .interactive import InteractiveCoarseGraph
 from .dashboard import PlotlyDashboard
+from . import batch
 
 class H_PHATE():
-    
-    def __init__(self, K=10, r=0.9, method='variation_edges'):
+
+    def __init__(self, K=10, r=0.9, method='variation_edges', incremental=False, prefetch=0,
+                 webgl=False, max_points=None, n_landmark=None, graph_params=None, interactive_params=None):
         self.K = K
         self.r = r
         self.method = method
-    
+        self.incremental = incremental
+        self.prefetch = prefetch
+        self.webgl = webgl
+        self.max_points = max_points
+        self.n_landmark = n_landmark
+        # further `CoarseGraph` parameters, e.g. knn_backend, n_pca, knn, n_jobs, gene_knn or compact
+        self.graph_params = {} if graph_params is None else graph_params
+        # further `InteractiveCoarseGraph` parameters, e.g. gene_graph='precomputed' with gene_knn
+        self.interactive_params = {} if interactive_params is None else interactive_params
+
     def fit(self, data):
-        self.cg_op = CoarseGraph(K=self.K, r=self.r, method=self.method).fit(data)
-        self.icg_op = InteractiveCoarseGraph(self.cg_op)
-        self.dashboard_op = PlotlyDashboard(self.icg_op)
+        cg_op = CoarseGraph(K=self.K, r=self.r, method=self.method, **self.graph_params).fit(data)
+        return self._build(cg_op)
+
+    def _build(self, cg_op):
+        self.cg_op = cg_op
+        self.icg_op = InteractiveCoarseGraph(self.cg_op, incremental=self.incremental,
+                                            n_landmark=self.n_landmark, **self.interactive_params)
+        self.dashboard_op = PlotlyDashboard(self.icg_op, prefetch=self.prefetch,
+                                            webgl=self.webgl, max_points=self.max_points)
+        return self
+
+    def save(self, path):
+        self.cg_op.save(path)
         return self
-    
+
+    @classmethod
+    def from_saved(cls, path, mmap_mode='r', incremental=False, prefetch=0,
+                   webgl=False, max_points=None, n_landmark=None, interactive_params=None):
+        cg_op = CoarseGraph.load(path, mmap_mode=mmap_mode)
+        h_phate_op = cls(K=cg_op.K, r=cg_op.r, method=cg_op.method, incremental=incremental,
+                         prefetch=prefetch, webgl=webgl, max_points=max_points,
+                         n_landmark=n_landmark, interactive_params=interactive_params)
+        return h_phate_op._build(cg_op)
+
+    def embed_selections(self, specs, n_jobs=1, embed_genes=False):
+        """Embeds a batch of selections without the dashboard, see `batch.embed_selections`."""
+        return batch.embed_selections(self.cg_op, specs, n_jobs=n_jobs, embed_genes=embed_genes,
+                                      incremental=self.incremental, n_landmark=self.n_landmark,
+                                      **self.interactive_params)
+
     @property
     def dashboard(self):
-        return self.dashboard_op.dashboard
\ No newline at end of file
+        return self.dashboard_op.dashboard
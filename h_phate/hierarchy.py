@@ -0,0 +1,112 @@
+import numpy as np
+
+
+def _ranges(starts, ends):
+    """Concatenation of `np.arange(start, end)` for each pair of bounds."""
+    lengths = ends - starts
+    shifts = starts - np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    return np.arange(np.sum(lengths)) + np.repeat(shifts, lengths)
+
+
+class HierarchyIndex():
+    """Vectorized lookups between the levels of a coarse graph hierarchy.
+
+    The nodes of each level are laid out in depth-first order, so the
+    descendants of a node at any lower level form one contiguous range of
+    that level's order. Multi-level queries then take one vectorized step
+    per level instead of one lookup per node.
+
+    Parameters
+    ----------
+    parents : dict
+        parents[i][j] gives the index in level i + 1 that
+        index j in level i maps to
+    level_sizes : list of int
+        number of nodes of each level
+
+    Attributes
+    ----------
+    offsets : array-like, shape=[n_levels + 1]
+        node j of level i has id `offsets[i] + j` among the nodes of all levels
+    order : dict
+        order[i] gives the level i nodes in depth-first order
+    position : dict
+        position[i][j] gives the index of level i node j in `order[i]`
+    child_offsets : dict
+        the children of the level i node at position p are
+        `order[i-1][child_offsets[i][p]:child_offsets[i][p+1]]`
+    """
+
+    def __init__(self, parents, level_sizes):
+        self.n_levels = len(level_sizes)
+        self.level_sizes = [int(n) for n in level_sizes]
+        self.offsets = np.concatenate([[0], np.cumsum(self.level_sizes)]).astype(int)
+        self.parents = {i: np.asarray(parents[i]) for i in range(self.n_levels - 1)}
+        top = self.n_levels - 1
+        self.order = {top: np.arange(self.level_sizes[top])}
+        self.position = {top: np.arange(self.level_sizes[top])}
+        self.child_offsets = dict()
+        for i in range(top, 0, -1):
+            parent_position = self.position[i][self.parents[i-1]]
+            self.order[i-1] = np.argsort(parent_position, kind='stable')
+            self.position[i-1] = np.empty_like(self.order[i-1])
+            self.position[i-1][self.order[i-1]] = np.arange(self.level_sizes[i-1])
+            counts = np.bincount(parent_position, minlength=self.level_sizes[i])
+            self.child_offsets[i] = np.concatenate([[0], np.cumsum(counts)])
+        self._ancestors = dict()
+
+    def ancestors(self, level, to_level):
+        """Ancestor at `to_level` of every node of `level`, computed once per pair of levels."""
+        if to_level < level:
+            raise ValueError("Expected to_level >= level. "
+                             "Got level={}, to_level={}".format(level, to_level))
+        if to_level == level:
+            return np.arange(self.level_sizes[level])
+        try:
+            return self._ancestors[(level, to_level)]
+        except KeyError:
+            pass
+        if to_level == level + 1:
+            ancestors = self.parents[level]
+        else:
+            ancestors = self.parents[to_level-1][self.ancestors(level, to_level - 1)]
+        self._ancestors[(level, to_level)] = ancestors
+        return ancestors
+
+    def descendant_ranges(self, level, nodes, to_level):
+        """Bounds in `order[to_level]` of the descendants of `nodes`.
+
+        Returns
+        -------
+        starts, ends : array-like, shape=[n_nodes]
+        """
+        if to_level > level:
+            raise ValueError("Expected to_level <= level. "
+                             "Got level={}, to_level={}".format(level, to_level))
+        starts = self.position[level][np.asarray(nodes, dtype=int)]
+        ends = starts + 1
+        for i in range(level, to_level, -1):
+            starts, ends = self.child_offsets[i][starts], self.child_offsets[i][ends]
+        return starts, ends
+
+    def descendants(self, level, nodes, to_level):
+        """Descendants at `to_level` of `nodes`, in depth-first order."""
+        return self.order[to_level][_ranges(*self.descendant_ranges(level, nodes, to_level))]
+
+    def children(self, level, nodes):
+        return self.descendants(level, nodes, level - 1)
+
+    def leaf_counts(self, level, nodes=None):
+        """Number of level 0 nodes under each of `nodes`, or under every node of `level`."""
+        if nodes is None:
+            nodes = np.arange(self.level_sizes[level])
+        starts, ends = self.descendant_ranges(level, nodes, 0)
+        return ends - starts
+
+    def leaves(self, level, nodes):
+        """Level 0 nodes under `nodes`."""
+        return self.descendants(level, nodes, 0)
+
+    def contains(self, level, nodes, leaves):
+        """Whether each of `leaves` lies under the matching node of `nodes` at `level`."""
+        return self.ancestors(0, level)[leaves] == nodes
@@ -1,96 +1,652 @@
-from .utils import setdiff1d
+from .utils import LRUCache, Superseded
+from . import profiling
 
 import numpy as np
 from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.spatial.distance import pdist, squareform
 import graphtools
 import phate
 import scprep
 
 class InteractiveCoarseGraph:
-    def __init__(self, cg_op):
+    def __init__(self, cg_op, incremental=False, incremental_iter=30, random_state=42,
+                 history_size=50, cache_bytes=2**27, gene_graph='exact', gene_n_pca=None,
+                 gene_n_landmark=None, n_landmark=None):
+        if gene_graph not in ['exact', 'precomputed']:
+            raise ValueError("Expected gene_graph in ['exact', 'precomputed']. Got {}".format(gene_graph))
+        if gene_graph == 'precomputed' and cg_op.gene_neighbors is None:
+            raise ValueError("gene_graph='precomputed' requires a CoarseGraph fitted with `gene_knn`")
+        if gene_graph == 'precomputed' and gene_n_pca is not None:
+            raise ValueError("gene_n_pca only applies to gene_graph='exact'. "
+                             "Got gene_n_pca={} with gene_graph='precomputed'".format(gene_n_pca))
         self.cg_op = cg_op
+        self.gene_graph = gene_graph
+        self.gene_n_pca = gene_n_pca
+        self.gene_n_landmark = gene_n_landmark
+        self.n_landmark = n_landmark
+        self.incremental = incremental
+        self.incremental_iter = incremental_iter
+        self.random_state = random_state
+        self.history_size = history_size
+        self._adjacency_blocks = dict()
+        self._embedding = None
+        self._embedding_cache = LRUCache(cache_bytes)
+        self._gene_embedding_cache = LRUCache(cache_bytes)
+        self._gene_expression_cache = LRUCache(cache_bytes)
+        # the nodes of level i are entries level_offsets[i]:level_offsets[i+1] of `mask`
+        self.level_offsets = cg_op.hierarchy.offsets
+        self.history = []
+        self.history_index = -1
         self.initialize()
         
     def initialize(self):
         self.level_nodes = self.cg_op.create_nodes_dict(initialized=True)
+        self._push_history()
+
+    @property
+    def level_nodes(self):
+        """Sorted visible nodes of each level."""
+        view = self._view
+        if view[1] is None:
+            view[1] = self._to_level_nodes(view[0])
+        return view[1]
+
+    @level_nodes.setter
+    def level_nodes(self, level_nodes):
+        self._set_mask(self._to_mask(level_nodes))
+
+    @property
+    def mask(self):
+        """Visible nodes of all levels as one boolean mask, see `level_offsets`."""
+        return self._view[0]
+
+    def _set_mask(self, mask):
+        # the mask and what is derived from it are replaced together,
+        # so a background embedding never mixes two views
+        self._view = [mask, None, None]
+
+    def _to_mask(self, level_nodes):
+        mask = np.zeros(self.level_offsets[-1], dtype=bool)
+        for level, nodes in enumerate(level_nodes):
+            mask[self.level_offsets[level] + np.asarray(nodes, dtype=int)] = True
+        return mask
+
+    def _to_level_nodes(self, mask):
+        return [np.flatnonzero(mask[self.level_offsets[level]:self.level_offsets[level+1]])
+                for level in range(self.cg_op.n_levels)]
+
+    def _get_mask(self, level_nodes=None):
+        mask, current, _ = self._view
+        if level_nodes is None or level_nodes is current:
+            return mask
+        return self._to_mask(level_nodes)
+
+    def _get_level_nodes(self, level_nodes=None):
+        return self.level_nodes if level_nodes is None else level_nodes
+
+    def _visible_ids(self, level_nodes=None):
+        """Indices of the visible nodes into the mask, in plot order."""
+        view = self._view
+        if level_nodes is None or level_nodes is view[1]:
+            if view[2] is None:
+                view[2] = np.flatnonzero(view[0])
+            return view[2]
+        return np.flatnonzero(self._to_mask(level_nodes))
+
+    def _split_ids(self, ids):
+        """Levels and per-level node indices of mask indices."""
+        levels = np.searchsorted(self.level_offsets, ids, side='right') - 1
+        return levels, ids - self.level_offsets[levels]
+
+    def snapshot(self, level_nodes=None):
+        """Returns a hashable snapshot of the visible nodes."""
+        return np.packbits(self._get_mask(level_nodes)).tobytes()
+
+    def restore(self, state):
+        """Sets the visible nodes from a snapshot returned by `snapshot`."""
+        self._set_mask(np.unpackbits(np.frombuffer(state, dtype=np.uint8),
+                                     count=self.level_offsets[-1]).astype(bool))
+
+    def _push_history(self):
+        state = self.snapshot()
+        if self.history_index >= 0 and self.history[self.history_index] == state:
+            return
+        self.history = self.history[:self.history_index + 1] + [state]
+        self.history = self.history[-self.history_size:]
+        self.history_index = len(self.history) - 1
+
+    def back(self):
+        """Restores the previous view. Returns False if there is none."""
+        if self.history_index <= 0:
+            return False
+        self.history_index -= 1
+        self.restore(self.history[self.history_index])
+        return True
+
+    def forward(self):
+        """Restores the next view after `back`. Returns False if there is none."""
+        if self.history_index >= len(self.history) - 1:
+            return False
+        self.history_index += 1
+        self.restore(self.history[self.history_index])
+        return True
         
-    def n_nodes(self):
-        return np.sum([len(nodes) for nodes in self.level_nodes])
+    def n_nodes(self, level_nodes=None):
+        return len(self._visible_ids(level_nodes))
 
-    def level_sizes(self):
-        return [len(self.level_nodes[i]) for i in range(self.cg_op.n_levels)]
+    def level_sizes(self, level_nodes=None):
+        level_nodes = self._get_level_nodes(level_nodes)
+        return [len(level_nodes[i]) for i in range(self.cg_op.n_levels)]
     
-    def level_boundaries(self):
-        return np.concatenate([[0], np.cumsum(self.level_sizes())])
+    def level_boundaries(self, level_nodes=None):
+        return np.concatenate([[0], np.cumsum(self.level_sizes(level_nodes))])
     
-    def select_nodes(self, select_idx):
-        select_nodes = self.cg_op.create_nodes_dict()
-        level_boundaries = self.level_boundaries()
-        for i in range(self.cg_op.n_levels):
-            level_select_idx = select_idx[(select_idx >= level_boundaries[i]) & 
-                                          (select_idx < level_boundaries[i+1])]
-            level_select_idx -= level_boundaries[i]
-            select_nodes[i] = self.level_nodes[i][level_select_idx]
-        return select_nodes
+    def select_nodes(self, select_idx, level_nodes=None):
+        levels, nodes = self._split_ids(self._visible_ids(level_nodes)[select_idx])
+        return [nodes[levels == level] for level in range(self.cg_op.n_levels)]
     
-    def set_operate_nodes(self, nodes1, nodes2, operator):
-        new_nodes = self.cg_op.create_nodes_dict()
-        for i in range(self.cg_op.n_levels):
-            new_nodes[i] = operator(nodes1[i], nodes2[i])
-        return new_nodes
-    
-    def refine(self, select_idx, remove_deselected=False):
-        select_nodes = self.select_nodes(select_idx)
-        refined_nodes = self.cg_op.refine(select_nodes)
-        if not remove_deselected:
-            deselect_nodes = self.set_operate_nodes(self.level_nodes, select_nodes, setdiff1d)
-            self.level_nodes = self.set_operate_nodes(refined_nodes, deselect_nodes, np.union1d)
+    def refine(self, select_idx, remove_deselected=False, level_nodes=None, to_level=None):
+        """Replaces the selected nodes by their children.
+
+        `select_idx` indexes the concatenation of `level_nodes`, which defaults
+        to the current view. The result becomes the current view.
+
+        If `to_level` is given, selected nodes above it are replaced by their
+        descendants at `to_level` in one step, e.g. `to_level=0` expands
+        straight to cells. Selected nodes at or below it stay visible.
+        """
+        self._set_mask(self._refined_mask(select_idx, remove_deselected, level_nodes, to_level))
+        self._push_history()
+
+    def _refined_mask(self, select_idx, remove_deselected, level_nodes, to_level=None):
+        ids = self._visible_ids(level_nodes)[select_idx]
+        if remove_deselected:
+            mask = np.zeros(self.level_offsets[-1], dtype=bool)
         else:
-            self.level_nodes = refined_nodes
+            mask = self._get_mask(level_nodes).copy()
+        levels, nodes = self._split_ids(ids)
+        for level in np.unique(levels):
+            target = max(level - 1, 0) if to_level is None else to_level
+            if level <= target:
+                # cells cannot be refined further
+                mask[ids[levels == level]] = True
+                continue
+            mask[ids[levels == level]] = False
+            descendants = self.cg_op.hierarchy.descendants(level, nodes[levels == level], target)
+            mask[self.level_offsets[target] + descendants] = True
+        return mask
     
-    def remove(self, select_idx):
-        select_nodes = self.select_nodes(select_idx)
-        self.level_nodes = self.set_operate_nodes(self.level_nodes, select_nodes, setdiff1d)
+    def remove(self, select_idx, level_nodes=None):
+        mask = self._get_mask(level_nodes).copy()
+        mask[self._visible_ids(level_nodes)[select_idx]] = False
+        self._set_mask(mask)
+        self._push_history()
 
-    def node_sizes(self):
+    def node_sizes(self, level_nodes=None):
         return np.concatenate([self.cg_op.node_sizes[level][nodes] 
-                               for level, nodes in enumerate(self.level_nodes)])
+                               for level, nodes in enumerate(self._get_level_nodes(level_nodes))])
+
+    def ancestor_groups(self, levels, level_nodes=None):
+        """Groups the visible nodes by their ancestor at `levels`.
+
+        Parameters
+        ----------
+        levels : int or array-like, shape=[n_nodes]
+            level to merge each visible node into. Nodes at or above it
+            form their own group.
+        level_nodes : list of arrays or None, optional (default: None)
+            If None, uses the current view.
+
+        Returns
+        -------
+        groups : array-like, shape=[n_nodes]
+            group of each visible node, numbered from 0
+        """
+        node_levels, nodes = self._split_ids(self._visible_ids(level_nodes))
+        target = np.maximum(levels, node_levels)
+        n_levels = self.cg_op.n_levels
+        pairs = node_levels * n_levels + target
+        for pair in np.unique(pairs):
+            level, to_level = divmod(pair, n_levels)
+            if to_level > level:
+                climb = pairs == pair
+                nodes[climb] = self.cg_op.hierarchy.ancestors(level, to_level)[nodes[climb]]
+        _, groups = np.unique(self.level_offsets[target] + nodes, return_inverse=True)
+        return groups
+
+    def cell_nodes(self, cells=None, level_nodes=None):
+        """Visible node containing each cell.
+
+        Parameters
+        ----------
+        cells : array-like or None, optional (default: None)
+            level 0 nodes. If None, uses all cells.
+        level_nodes : list of arrays or None, optional (default: None)
+            If None, uses the current view.
+
+        Returns
+        -------
+        node_idx : array-like, shape=[n_cells]
+            index of the visible node containing each cell in plot order,
+            or -1 if none of its ancestors is visible
+        """
+        hierarchy = self.cg_op.hierarchy
+        if cells is None:
+            cells = np.arange(self.cg_op.level_sizes[0])
+        cells = np.asarray(cells, dtype=int)
+        mask = self._get_mask(level_nodes)
+        plot_idx = np.cumsum(mask) - 1
+        node_idx = np.full(len(cells), -1)
+        for level in range(self.cg_op.n_levels):
+            missing = np.flatnonzero(node_idx < 0)
+            if len(missing) == 0:
+                break
+            ids = self.level_offsets[level] + hierarchy.ancestors(0, level)[cells[missing]]
+            found = mask[ids]
+            node_idx[missing[found]] = plot_idx[ids[found]]
+        return node_idx
+
+    def landmarks(self, level_nodes=None, A=None):
+        """Groups the visible nodes into at most `n_landmark` representatives.
+
+        Visible nodes are merged into their ancestors at the lowest level
+        that leaves at most `n_landmark` groups. If even the top level leaves
+        more, the `n_landmark` largest groups are kept and every other group
+        joins the kept group it is most connected to, propagating over the
+        adjacency. Top-level groups share no ancestor, so each connected
+        component with no path to a kept group joins the smallest landmark
+        as a whole, largest component first.
+
+        Parameters
+        ----------
+        level_nodes : list of arrays or None, optional (default: None)
+            If None, uses the current view.
+        A : sparse matrix or None, optional (default: None)
+            adjacency of the visible nodes, computed if needed and None
 
-    def gene_expression(self):
-        return sparse.hstack([self.cg_op.gene_expression[level][:,nodes]
-                          for level, nodes in enumerate(self.level_nodes)])
+        Returns
+        -------
+        groups : array-like, shape=[n_nodes]
+            landmark of each visible node, numbered from 0 to at most
+            `n_landmark - 1`
+        """
+        level_nodes = self._get_level_nodes(level_nodes)
+        for level in range(self.cg_op.n_levels):
+            groups = self.ancestor_groups(level, level_nodes)
+            n_groups = groups.max() + 1
+            if n_groups <= self.n_landmark:
+                return groups
+        if A is None:
+            A = self.adjacency(level_nodes)
+        C = sparse.csr_matrix((np.ones(len(groups)), (np.arange(len(groups)), groups)),
+                              shape=(len(groups), n_groups))
+        A_groups = (C.T @ A @ C).tocsr()
+        sizes = np.bincount(groups, weights=self.node_sizes(level_nodes), minlength=n_groups)
+        labels = np.full(n_groups, -1)
+        labels[np.argsort(-sizes, kind='stable')[:self.n_landmark]] = np.arange(self.n_landmark)
+        while True:
+            unassigned = np.flatnonzero(labels < 0)
+            assigned = np.flatnonzero(labels >= 0)
+            votes = A_groups[unassigned][:,assigned] @ sparse.csr_matrix(
+                (np.ones(len(assigned)), (np.arange(len(assigned)), labels[assigned])),
+                shape=(len(assigned), self.n_landmark))
+            reached = np.diff(votes.indptr) > 0
+            if len(unassigned) == 0 or not np.any(reached):
+                break
+            labels[unassigned[reached]] = np.asarray(votes[reached].argmax(axis=1)).flatten()
+        unassigned = np.flatnonzero(labels < 0)
+        if len(unassigned) > 0:
+            _, components = csgraph.connected_components(
+                A_groups[unassigned][:,unassigned], directed=False)
+            component_sizes = np.bincount(components, weights=sizes[unassigned])
+            landmark_sizes = np.bincount(labels[labels >= 0], weights=sizes[labels >= 0],
+                                         minlength=self.n_landmark)
+            component_labels = np.empty(len(component_sizes), dtype=int)
+            for component in np.argsort(-component_sizes, kind='stable'):
+                component_labels[component] = np.argmin(landmark_sizes)
+                landmark_sizes[component_labels[component]] += component_sizes[component]
+            labels[unassigned] = component_labels[components]
+        return labels[groups]
+
+    def expansion_candidates(self, n_candidates, level_nodes=None):
+        """Indices of the largest visible nodes above level 0, largest first."""
+        level_nodes = self._get_level_nodes(level_nodes)
+        node_sizes = self.node_sizes(level_nodes)
+        coarse_idx = np.arange(len(level_nodes[0]), len(node_sizes))
+        order = np.argsort(-node_sizes[coarse_idx], kind='stable')
+        return coarse_idx[order[:n_candidates]]
+
+    def prefetch(self, select_idx, remove_deselected=False, level_nodes=None, should_stop=None):
+        """Embeds the view `refine` would produce into the embedding cache.
+
+        Neither the view, the embedding used to warm-start the next
+        incremental embedding nor the reused adjacency blocks change, so
+        prefetching can run alongside `embed`. `should_stop` is as in `embed`.
+        """
+        refined_nodes = self._to_level_nodes(self._refined_mask(select_idx, remove_deselected, level_nodes))
+        state = self.snapshot(refined_nodes)
+        if state in self._embedding_cache:
+            return
+        with profiling.stage("prefetch", n_nodes=self.n_nodes(refined_nodes)):
+            self._embedding_cache[state] = self._embed(refined_nodes, self.incremental, should_stop,
+                                                       store_blocks=False)
+
+    def gene_expression(self, level_nodes=None, format='csr'):
+        """Gene by node expression of the visible nodes.
+
+        Both the 'csr' and 'csc' orientations are cached per view.
+        """
+        level_nodes = self._get_level_nodes(level_nodes)
+        state = self.snapshot(level_nodes)
+        try:
+            X_csr, X_csc = self._gene_expression_cache[state]
+        except KeyError:
+            with profiling.stage("gene_expression", n_nodes=self.n_nodes(level_nodes)) as stage:
+                X_csr = sparse.hstack([self.cg_op.gene_expression[level][:,nodes]
+                                       for level, nodes in enumerate(level_nodes)]).tocsr()
+                X_csc = X_csr.tocsc()
+                stage.update(nnz=X_csr.nnz)
+            self._gene_expression_cache[state] = (X_csr, X_csc)
+        if format == 'csr':
+            return X_csr
+        elif format == 'csc':
+            return X_csc
+        else:
+            raise ValueError("Expected format in ['csr', 'csc']. Got {}".format(format))
     
-    def adjacency(self):
-        level_boundaries = self.level_boundaries()
+    def _adjacency_block(self, to_level, from_level, level_nodes, store=True):
+        """Returns A[(to_level, from_level)] restricted to the visible nodes as COO.
+
+        Blocks are reused while the visible nodes of both levels are unchanged.
+        If not `store`, a block that is computed is not kept for reuse.
+        """
+        to_nodes = level_nodes[to_level]
+        from_nodes = level_nodes[from_level]
+        try:
+            cached_to, cached_from, block = self._adjacency_blocks[(to_level, from_level)]
+            if np.array_equal(cached_to, to_nodes) and np.array_equal(cached_from, from_nodes):
+                return block
+        except KeyError:
+            pass
+        block = self.cg_op.adjacency.submatrix(to_level, from_level, to_nodes, from_nodes).tocoo()
+        if to_level == from_level:
+            offdiag = block.row != block.col
+            block = sparse.coo_matrix((block.data[offdiag], (block.row[offdiag], block.col[offdiag])),
+                                      shape=block.shape)
+        if store:
+            self._adjacency_blocks[(to_level, from_level)] = (to_nodes, from_nodes, block)
+        return block
+
+    def adjacency(self, level_nodes=None, store_blocks=True):
+        level_nodes = self._get_level_nodes(level_nodes)
+        level_boundaries = self.level_boundaries(level_nodes)
         N = level_boundaries[-1]
-        A = self.cg_op.adjacency
-        A_combined = sparse.lil_matrix((N, N))
-        for to_level in range(self.cg_op.n_levels):
-            to_level_idx = np.arange(level_boundaries[to_level], level_boundaries[to_level+1])
-            if len(to_level_idx) == 0:
-                continue
-            for from_level in range(0, to_level+1):
-                from_level_idx = np.arange(level_boundaries[from_level], level_boundaries[from_level + 1])
-                if len(from_level_idx) == 0:
+        with profiling.stage("adjacency", n_nodes=N) as stage:
+            rows, cols, data = [np.arange(N)], [np.arange(N)], [np.ones(N)]
+            for to_level in range(self.cg_op.n_levels):
+                if level_boundaries[to_level] == level_boundaries[to_level+1]:
                     continue
-                A_submatrix = A[(to_level, from_level)][self.level_nodes[to_level]][:,self.level_nodes[from_level]]
-                graphtools.matrix.set_submatrix(A_combined, to_level_idx, from_level_idx, A_submatrix)
-                if from_level != to_level:
-                    graphtools.matrix.set_submatrix(A_combined, from_level_idx, to_level_idx, A_submatrix.T)
-
-        A_combined = graphtools.matrix.set_diagonal(A_combined, 1)
+                for from_level in range(0, to_level+1):
+                    if level_boundaries[from_level] == level_boundaries[from_level+1]:
+                        continue
+                    block = self._adjacency_block(to_level, from_level, level_nodes, store_blocks)
+                    block_rows = block.row + level_boundaries[to_level]
+                    block_cols = block.col + level_boundaries[from_level]
+                    rows.append(block_rows)
+                    cols.append(block_cols)
+                    data.append(block.data)
+                    if from_level != to_level:
+                        rows.append(block_cols)
+                        cols.append(block_rows)
+                        data.append(block.data)
+            A_combined = sparse.coo_matrix(
+                (np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+                shape=(N, N)).tocsr()
+            stage.update(nnz=A_combined.nnz)
         return A_combined
-    
-    def embed(self):
-        A = self.adjacency()
-        node_sizes = self.node_sizes()
-        Y = phate.PHATE(knn_dist='precomputed_affinity', verbose=0).fit_transform(A)
+
+    def _initial_coordinates(self, level_nodes):
+        """Initializes the embedding of the visible nodes from the previous embedding.
+
+        Nodes that were visible keep their coordinates and newly revealed nodes
+        start at the position of their closest previously visible ancestor.
+
+        Returns
+        -------
+        Y0 : array-like or None
+            None if some visible node has no previously visible ancestor
+        """
+        if self._embedding is None:
+            return None
+        prev_level_nodes, prev_Y = self._embedding
+        prev_boundaries = np.concatenate([[0], np.cumsum([len(nodes) for nodes in prev_level_nodes])])
+        Y0 = []
+        for level, nodes in enumerate(level_nodes):
+            level_Y0 = np.full((len(nodes), prev_Y.shape[1]), np.nan)
+            missing = np.arange(len(nodes))
+            ancestors = nodes
+            for ancestor_level in range(level, self.cg_op.n_levels):
+                if ancestor_level > level:
+                    ancestors = self.cg_op.hierarchy.parents[ancestor_level-1][ancestors]
+                prev_nodes = prev_level_nodes[ancestor_level]
+                idx = np.searchsorted(prev_nodes, ancestors)
+                found = idx < len(prev_nodes)
+                found[found] = prev_nodes[idx[found]] == ancestors[found]
+                level_Y0[missing[found]] = prev_Y[prev_boundaries[ancestor_level] + idx[found]]
+                missing, ancestors = missing[~found], ancestors[~found]
+                if len(missing) == 0:
+                    break
+            if len(missing) > 0:
+                return None
+            Y0.append(level_Y0)
+        Y0 = np.concatenate(Y0)
+        # separate children initialized at the same position
+        rng = np.random.RandomState(self.random_state)
+        Y0 += rng.normal(scale=1e-3 * np.std(prev_Y), size=Y0.shape)
+        return Y0
+
+    @staticmethod
+    def _check(should_stop):
+        if should_stop is not None and should_stop():
+            raise Superseded()
+
+    def _embed_incremental(self, A, Y0, should_stop=None):
+        phate_op = phate.PHATE(knn_dist='precomputed_affinity', verbose=0,
+                               random_state=self.random_state)
+        phate_op.fit(A)
+        self._check(should_stop)
+        potential = phate_op._calculate_potential()
+        self._check(should_stop)
+        graph = phate_op.graph
+        if isinstance(graph, graphtools.graphs.LandmarkGraph):
+            # landmarks are the unique cluster labels in sorted order, which need not be contiguous
+            _, clusters = np.unique(graph.clusters, return_inverse=True)
+            counts = np.bincount(clusters, minlength=potential.shape[0])
+            Y0 = np.column_stack([np.bincount(clusters, weights=Y0[:,i], minlength=potential.shape[0])
+                                  for i in range(Y0.shape[1])]) / np.maximum(counts, 1)[:,None]
+        D = squareform(pdist(potential))
+        # rescale the initialization to the potential distances, and back after MDS
+        D0 = squareform(pdist(Y0))
+        scale = np.sum(D * D0) / np.sum(D0 ** 2)
+        Y = phate.mds.smacof(D, init=Y0 * scale, max_iter=self.incremental_iter,
+                             random_state=self.random_state) / scale
+        if isinstance(graph, graphtools.graphs.LandmarkGraph):
+            Y = graph.interpolate(Y)
+        return Y
+
+    def _embed_landmarks(self, A, node_sizes, groups, Y0=None, should_stop=None):
+        """Embeds the landmark `groups` with PHATE and interpolates every node from them.
+
+        The affinity between two landmarks is the mean affinity between their
+        nodes, weighted by `node_sizes`. Each node is then placed at the average
+        of the landmarks, weighted by its affinity to their nodes.
+        """
+        n_groups = groups.max() + 1
+        rows = np.arange(len(groups))
+        weights = node_sizes / np.bincount(groups, weights=node_sizes)[groups]
+        C = sparse.csr_matrix((weights, (rows, groups)), shape=(len(groups), n_groups))
+        A_landmark = C.T @ A @ C
+        if Y0 is not None:
+            Y_landmark = self._embed_incremental(A_landmark, C.T @ Y0, should_stop)
+        else:
+            Y_landmark = phate.PHATE(knn_dist='precomputed_affinity', n_landmark=None, verbose=0,
+                                     random_state=self.random_state).fit_transform(A_landmark)
+        transitions = A @ sparse.csr_matrix((np.ones(len(groups)), (rows, groups)),
+                                            shape=(len(groups), n_groups))
+        transitions = sparse.diags(1 / np.asarray(transitions.sum(axis=1)).flatten()) @ transitions
+        return transitions @ Y_landmark
+
+    def _embed(self, level_nodes, incremental, should_stop=None, store_blocks=True):
+        """Embeds `level_nodes` without touching the embedding cache or the previous embedding."""
+        A = self.adjacency(level_nodes, store_blocks)
+        node_sizes = self.node_sizes(level_nodes)
+        Y0 = self._initial_coordinates(level_nodes) if incremental else None
+        self._check(should_stop)
+        landmark = self.n_landmark is not None and len(node_sizes) > self.n_landmark
+        with profiling.stage("phate", incremental=Y0 is not None, landmark=landmark):
+            if landmark:
+                Y = self._embed_landmarks(A, node_sizes, self.landmarks(level_nodes, A), Y0,
+                                          should_stop)
+            elif Y0 is not None:
+                Y = self._embed_incremental(A, Y0, should_stop)
+            else:
+                phate_op = phate.PHATE(knn_dist='precomputed_affinity', verbose=0,
+                                       random_state=self.random_state).fit(A)
+                self._check(should_stop)
+                phate_op._calculate_potential()
+                self._check(should_stop)
+                Y = phate_op.transform()
+        return Y, node_sizes
+
+    def embed(self, incremental=None, level_nodes=None, should_stop=None):
+        """Embeds the visible nodes with PHATE.
+
+        Parameters
+        ----------
+        incremental : bool or None, optional (default: None)
+            If True, warm-start MDS from the previous embedding and run only
+            `incremental_iter` iterations. Falls back to a full embedding if
+            some visible node has no previously visible ancestor.
+            If None, uses `self.incremental`.
+        level_nodes : list of arrays or None, optional (default: None)
+            Nodes to embed. If None, uses the current view.
+        should_stop : callable or None, optional (default: None)
+            checked between the adjacency and the PHATE stages. If it returns
+            True, the embedding stops and raises `Superseded`.
+
+        If `n_landmark` is set and more nodes are visible, PHATE runs on the
+        groups from `landmarks` and the visible nodes are interpolated from
+        them, so the cost of PHATE does not grow with the view.
+
+        Returns
+        -------
+        Y : array-like, shape=[n_nodes, 2]
+        node_sizes : array-like, shape=[n_nodes]
+        """
+        level_nodes = self._get_level_nodes(level_nodes)
+        state = self.snapshot(level_nodes)
+        with profiling.stage("embed", n_nodes=self.n_nodes(level_nodes)) as stage:
+            try:
+                Y, node_sizes = self._embedding_cache[state]
+                self._embedding = (level_nodes, Y)
+                stage.update(cached=True)
+                return Y, node_sizes
+            except KeyError:
+                pass
+            if incremental is None:
+                incremental = self.incremental
+            Y, node_sizes = self._embed(level_nodes, incremental, should_stop)
+            self._embedding = (level_nodes, Y)
+            self._embedding_cache[state] = (Y, node_sizes)
+            stage.update(cached=False)
         return Y, node_sizes
     
-    def embed_genes(self):
-        X = self.gene_expression()
-        gene_list = self.cg_op.gene_list
-        gene_idx = np.arange(len(gene_list))
-        X, gene_list, gene_idx = scprep.filter.filter_empty_cells(X, gene_list, gene_idx)
-        Y = phate.PHATE(knn_max=15, verbose=0).fit_transform(X)
+    def gene_affinity(self, level_nodes=None, thresh=1e-4, chunk_size=2**16):
+        """Gene x gene alpha-decay affinities over the visible nodes.
+
+        The candidate neighbors precomputed on each level with visible nodes
+        are pooled, and the distances between candidates are recomputed from
+        the expression in the visible nodes only, `chunk_size` candidate
+        pairs at a time. The bandwidth of each gene is the distance to its
+        `gene_knn`-th nearest candidate.
+        """
+        level_nodes = self._get_level_nodes(level_nodes)
+        neighbors = np.hstack([self.cg_op.gene_neighbors[level]
+                               for level, nodes in enumerate(level_nodes) if len(nodes) > 0])
+        n_genes = neighbors.shape[0]
+        candidates = sparse.csr_matrix(
+            (np.ones(neighbors.size), (np.repeat(np.arange(n_genes), neighbors.shape[1]), neighbors.ravel())),
+            shape=(n_genes, n_genes))
+        rows = np.repeat(np.arange(n_genes), np.diff(candidates.indptr))
+        cols = candidates.indices
+        X = self.gene_expression(level_nodes)
+        squared_norms = np.asarray(X.multiply(X).sum(axis=1)).flatten()
+        dots = np.empty(len(rows))
+        for start in range(0, len(rows), chunk_size):
+            pairs = slice(start, start + chunk_size)
+            dots[pairs] = np.asarray(X[rows[pairs]].multiply(X[cols[pairs]]).sum(axis=1)).flatten()
+        distances = np.sqrt(np.maximum(squared_norms[rows] + squared_norms[cols] - 2 * dots, 0))
+        # each row holds the gene itself at distance 0, then its candidates
+        order = np.lexsort((distances, rows))
+        rank = np.arange(len(rows)) - candidates.indptr[rows]
+        kth = rank == np.minimum(self.cg_op.gene_knn, np.diff(candidates.indptr)[rows] - 1)
+        bandwidth = np.empty(n_genes)
+        bandwidth[rows[kth]] = distances[order][kth]
+        bandwidth[bandwidth == 0] = np.finfo(float).eps
+        affinity = np.exp(-(distances / bandwidth[rows]) ** self.cg_op.decay)
+        affinity[affinity < thresh] = 0
+        K = sparse.csr_matrix((affinity, (rows, cols)), shape=(n_genes, n_genes))
+        K.eliminate_zeros()
+        return (K + K.T) / 2
+
+    def embed_genes(self, level_nodes=None, should_stop=None):
+        """Embeds the genes expressed in the visible nodes with PHATE.
+
+        With `gene_graph='precomputed'`, the gene graph is `gene_affinity`, which
+        skips the neighbor search and `gene_n_pca` does not apply. Otherwise
+        it is built by PHATE from the expression in the visible nodes, reduced
+        to `gene_n_pca` components (PHATE's default if None). Most of the time is spent on the diffusion
+        potential, which `gene_n_landmark` bounds. `should_stop` is checked
+        between the expression, graph and potential stages, as in `embed`.
+
+        Returns
+        -------
+        Y : array-like, shape=[n_genes, 2]
+        gene_list : array-like, shape=[n_genes]
+        gene_idx : array-like, shape=[n_genes]
+            indices of the embedded genes in `cg_op.gene_list`
+        """
+        level_nodes = self._get_level_nodes(level_nodes)
+        state = self.snapshot(level_nodes)
+        with profiling.stage("embed_genes", n_nodes=self.n_nodes(level_nodes)) as stage:
+            try:
+                result = self._gene_embedding_cache[state]
+                stage.update(cached=True)
+                return result
+            except KeyError:
+                pass
+            X = self.gene_expression(level_nodes)
+            gene_list = self.cg_op.gene_list
+            gene_idx = np.arange(len(gene_list))
+            X, gene_list, gene_idx = scprep.filter.filter_empty_cells(X, gene_list, gene_idx)
+            self._check(should_stop)
+            params = dict(verbose=0)
+            if self.gene_n_landmark is not None:
+                params['n_landmark'] = self.gene_n_landmark
+            with profiling.stage("phate", n_genes=len(gene_list), gene_graph=self.gene_graph):
+                if self.gene_graph == 'precomputed':
+                    A = self.gene_affinity(level_nodes).tocsr()[gene_idx][:,gene_idx]
+                    self._check(should_stop)
+                    phate_op = phate.PHATE(knn_dist='precomputed_affinity', **params).fit(A)
+                else:
+                    if self.gene_n_pca is not None:
+                        params['n_pca'] = self.gene_n_pca
+                    phate_op = phate.PHATE(knn_max=15, **params).fit(X)
+                self._check(should_stop)
+                phate_op._calculate_potential()
+                self._check(should_stop)
+                Y = phate_op.transform()
+            self._gene_embedding_cache[state] = (Y, gene_list, gene_idx)
+            stage.update(cached=False)
         return Y, gene_list, gene_idx
\ No newline at end of file
@@ -0,0 +1,69 @@
+import json
+import os
+
+import numpy as np
+from scipy import sparse
+
+FORMAT_VERSION = 5
+MANIFEST = "manifest.json"
+
+_SPARSE_FORMATS = {
+    'csr': sparse.csr_matrix,
+    'csc': sparse.csc_matrix,
+}
+
+
+def save_array(path, name, X):
+    np.save(os.path.join(path, name + ".npy"), np.ascontiguousarray(X))
+
+
+def load_array(path, name, mmap_mode='r'):
+    return np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+
+
+def save_sparse(path, name, X):
+    """Saves a sparse matrix as separate .npy files so it can be memory-mapped.
+
+    Returns
+    -------
+    info : dict
+        format and shape of the matrix, to be stored in the manifest
+    """
+    if not sparse.isspmatrix_csc(X):
+        X = sparse.csr_matrix(X)
+    X.sort_indices()
+    fmt = X.getformat()
+    save_array(path, name + ".data", X.data)
+    save_array(path, name + ".indices", X.indices)
+    save_array(path, name + ".indptr", X.indptr)
+    return dict(format=fmt, shape=list(X.shape))
+
+
+def load_sparse(path, name, info, mmap_mode='r'):
+    data = load_array(path, name + ".data", mmap_mode=mmap_mode)
+    indices = load_array(path, name + ".indices", mmap_mode=mmap_mode)
+    indptr = load_array(path, name + ".indptr", mmap_mode=mmap_mode)
+    matrix_class = _SPARSE_FORMATS[info['format']]
+    X = matrix_class((data, indices, indptr), shape=tuple(info['shape']), copy=False)
+    X.has_sorted_indices = True
+    return X
+
+
+def write_manifest(path, manifest, version=FORMAT_VERSION):
+    manifest = dict(manifest, format_version=version)
+    with open(os.path.join(path, MANIFEST), 'w') as handle:
+        json.dump(manifest, handle, indent=1)
+
+
+def read_manifest(path, version=FORMAT_VERSION):
+    manifest_path = os.path.join(path, MANIFEST)
+    if not os.path.isfile(manifest_path):
+        raise FileNotFoundError(
+            "No saved data found at {}".format(path))
+    with open(manifest_path) as handle:
+        manifest = json.load(handle)
+    if manifest.get('format_version') != version:
+        raise ValueError(
+            "Saved data at {} has format version {}, expected {}. "
+            "Save it again.".format(path, manifest.get('format_version'), version))
+    return manifest
@@ -0,0 +1,187 @@
+"""Per-stage timing and memory instrumentation.
+
+Instrumentation is disabled by default and `stage` then returns a shared
+no-op context, so instrumented code pays one function call per stage.
+
+Examples
+--------
+>>> h_phate.profiling.enable(memory=True)
+>>> icg_op.embed()
+>>> h_phate.profiling.last_report('embed')
+[{'name': 'embed', 'path': 'embed', 'depth': 0, 'seconds': 1.2, ...},
+ {'name': 'adjacency', 'path': 'embed/adjacency', 'depth': 1, ...}, ...]
+"""
+import threading
+import time
+import tracemalloc
+import warnings
+
+_enabled = False
+_track_memory = False
+_hooks = []
+_local = threading.local()
+_last_report = None
+# last report of each top-level stage name, as background workers interleave them
+_last_reports = dict()
+
+
+class _NullStage():
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def update(self, **sizes):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage():
+
+    def __init__(self, name, sizes):
+        self.name = name
+        self.sizes = sizes
+        self.children = []
+        self.seconds = None
+        self.memory_delta = None
+
+    def update(self, **sizes):
+        """Records sizes only known once the stage has run, e.g. the nnz of its result."""
+        self.sizes.update(sizes)
+
+    def __enter__(self):
+        stack = _get_stack()
+        self.parent = stack[-1] if len(stack) > 0 else None
+        self.path = self.name if self.parent is None else "{}/{}".format(self.parent.path, self.name)
+        self.depth = len(stack)
+        stack.append(self)
+        self._memory_start = tracemalloc.get_traced_memory()[0] if _track_memory else None
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self._start
+        if self._memory_start is not None and tracemalloc.is_tracing():
+            self.memory_delta = tracemalloc.get_traced_memory()[0] - self._memory_start
+        _get_stack().pop()
+        if self.parent is not None:
+            self.parent.children.append(self)
+        record = self.to_dict()
+        for hook in list(_hooks):
+            try:
+                hook(record)
+            except Exception as err:
+                warnings.warn("Profiling hook {} failed: {}".format(hook, err), RuntimeWarning)
+        if self.parent is None:
+            global _last_report
+            _last_report = _last_reports[self.name] = self.flatten()
+        return False
+
+    def to_dict(self):
+        return dict(name=self.name, path=self.path, depth=self.depth,
+                    seconds=self.seconds, memory_delta=self.memory_delta,
+                    thread=threading.current_thread().name, **self.sizes)
+
+    def flatten(self):
+        records = [self.to_dict()]
+        for child in self.children:
+            records.extend(child.flatten())
+        return records
+
+
+def _get_stack():
+    try:
+        return _local.stack
+    except AttributeError:
+        _local.stack = []
+        return _local.stack
+
+
+def stage(name, **sizes):
+    """Context manager timing the enclosed code as stage `name`.
+
+    Parameters
+    ----------
+    name : str
+        stage name. Nested stages are reported as `parent/child`.
+    sizes : additional keyword arguments
+        sizes to report with the stage, e.g. `n_nodes` or `nnz`
+    """
+    if not _enabled:
+        return _NULL_STAGE
+    return _Stage(name, sizes)
+
+
+def enable(memory=False, hook=None):
+    """Enables instrumentation.
+
+    Parameters
+    ----------
+    memory : bool, optional (default: False)
+        If True, start `tracemalloc` and report the change in traced memory
+        of each stage. This slows down allocation-heavy code. Traced memory
+        is process-wide: while stages run on several threads, e.g. the
+        dashboard's background workers, a stage's `memory_delta` includes
+        the allocations of the other threads.
+    hook : callable or None, optional (default: None)
+        called with the record of every completed stage, see `add_hook`
+    """
+    global _enabled, _track_memory
+    _enabled = True
+    _track_memory = memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if hook is not None:
+        add_hook(hook)
+
+
+def disable():
+    """Disables instrumentation and removes all hooks."""
+    global _enabled, _track_memory
+    _enabled = False
+    if _track_memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _track_memory = False
+    del _hooks[:]
+
+
+def is_enabled():
+    return _enabled
+
+
+def add_hook(hook):
+    """Registers `hook(record)` to forward every completed stage, e.g. to a metrics system.
+
+    `record` is a dict with keys `name`, `path`, `depth`, `seconds`,
+    `memory_delta`, `thread` and the sizes reported by the stage.
+    """
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+
+def last_report(name=None):
+    """Records of the most recently completed top-level stage and its nested stages.
+
+    Parameters
+    ----------
+    name : str or None, optional (default: None)
+        If given, the most recent top-level stage with this name, e.g.
+        'rebuild', so that stages completed meanwhile on other threads,
+        e.g. 'prefetch', do not replace it.
+
+    Returns
+    -------
+    report : list of dict or None
+        one record per stage in depth-first order, or None if no such stage
+        has completed since instrumentation was enabled
+    """
+    if name is None:
+        return _last_report
+    return _last_reports.get(name)
@@ -1,12 +1,15 @@
 import numpy as np
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+from scipy import sparse
+
+from . import profiling
+from .hierarchy import _ranges
+
 
-def setdiff1d(x, y):
-    if len(x) > 0 and len(y) > 0:
-        return np.setdiff1d(x, y)
-    else:
-        return x
-    
 class Lock():
     def __init__(self):
         self._lock = False
@@ -30,4 +33,365 @@ class Lock():
                 raise
         except:
             self._lock = False
-            raise
\ No newline at end of file
+            raise
+
+
+def nbytes(obj, seen=None):
+    """Approximate memory footprint of arrays, sparse matrices and containers thereof.
+
+    If `seen` is a set, arrays whose id is in it are not counted again and
+    the ids of counted arrays are added to it.
+    """
+    if isinstance(obj, np.ndarray):
+        if seen is not None:
+            if id(obj) in seen:
+                return 0
+            seen.add(id(obj))
+        return obj.nbytes
+    elif sparse.isspmatrix_coo(obj):
+        return nbytes(obj.data, seen) + nbytes(obj.row, seen) + nbytes(obj.col, seen)
+    elif sparse.issparse(obj):
+        return nbytes(obj.data, seen) + nbytes(obj.indices, seen) + nbytes(obj.indptr, seen)
+    elif isinstance(obj, PatchableSparse):
+        return nbytes([obj._data, obj._indices, obj._starts, obj._ends], seen)
+    elif isinstance(obj, (tuple, list)):
+        return np.sum([nbytes(o, seen) for o in obj], dtype=int)
+    else:
+        return sys.getsizeof(obj)
+
+
+def _grow(array, size):
+    """`array` if it holds `size` entries, else a copy with room for at least twice as many."""
+    if len(array) >= size:
+        return array
+    grown = np.empty(max(size, 2 * len(array)), dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+def append(array, values):
+    """`np.concatenate([array, values])` in time proportional to `values`.
+
+    `values` are written into spare room after `array` when it is the
+    start of a buffer returned by an earlier call, and the returned array
+    is a view of that buffer. Arrays appended to must not be shared.
+    """
+    n = len(array)
+    buffer = array.base
+    if (not isinstance(buffer, np.ndarray) or buffer.ndim != 1 or buffer.dtype != array.dtype
+            or not buffer.flags.owndata or not buffer.flags.writeable
+            or not np.shares_memory(array[:1], buffer[:1]) or array.strides != buffer.strides):
+        buffer = array
+    buffer = _grow(buffer, n + len(values))
+    buffer[n:n+len(values)] = values
+    return buffer[:n+len(values)]
+
+
+class PatchableSparse():
+    """Sparse matrix whose rows, or columns if `axis=1`, can be appended
+    or replaced in time proportional to the entries written.
+
+    The entries of each row (column) are stored contiguously in buffers
+    with spare room. A replaced row is written after the stored entries
+    and the space it held is reclaimed once dead entries outnumber live
+    ones. Selecting rows (columns), and multiplying by a sparse matrix on
+    the left if `axis=0`, only reads the entries of the rows involved.
+
+    Parameters
+    ----------
+    X : sparse matrix
+    axis : {0, 1}, optional (default: 0)
+        axis along which the matrix is patched
+    """
+
+    def __init__(self, X, axis=0):
+        self.axis = axis
+        X = sparse.csr_matrix(X if axis == 0 else X.T)
+        self.n_rows, self.n_cols = X.shape
+        self.nnz = X.nnz
+        self.dtype = X.dtype
+        self._data = X.data[:X.nnz]
+        self._indices = X.indices[:X.nnz]
+        self._starts = X.indptr[:-1].astype(np.int64)
+        self._ends = X.indptr[1:].astype(np.int64)
+        # entries written to the buffers, live or dead
+        self._size = X.nnz
+
+    @property
+    def shape(self):
+        return (self.n_rows, self.n_cols) if self.axis == 0 else (self.n_cols, self.n_rows)
+
+    def _select(self, rows):
+        starts, ends = self._starts[rows], self._ends[rows]
+        entries = _ranges(starts, ends)
+        indptr = np.concatenate([[0], np.cumsum(ends - starts)])
+        return sparse.csr_matrix((self._data[entries], self._indices[entries], indptr),
+                                 shape=(len(rows), self.n_cols))
+
+    def __getitem__(self, key):
+        rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+        if self.axis == 1:
+            rows, cols = cols, rows
+        X = self._select(np.arange(self.n_rows)[rows])
+        if not (isinstance(cols, slice) and cols == slice(None)):
+            X = X[:,cols]
+        return X if self.axis == 0 else X.T
+
+    def tosparse(self):
+        """The whole matrix, in CSR format if `axis=0` and CSC format if `axis=1`."""
+        X = self._select(np.arange(self.n_rows))
+        return X if self.axis == 0 else X.T
+
+    def __matmul__(self, other):
+        return self.tosparse() @ other
+
+    def __rmatmul__(self, other):
+        if self.axis == 1:
+            return other @ self.tosparse()
+        other = sparse.csr_matrix(other)
+        rows = np.unique(other.indices)
+        return other[:,rows] @ self._select(rows)
+
+    def _as_rows(self, X):
+        X = sparse.csr_matrix(X if self.axis == 0 else X.T)
+        if X.shape[1] != self.n_cols:
+            raise ValueError("Expected {} entries per {}. Got {}".format(
+                self.n_cols, "row" if self.axis == 0 else "column", X.shape[1]))
+        X.sum_duplicates()
+        return X
+
+    def _write(self, X):
+        """Writes the entries of CSR `X` after the stored ones and returns the bounds of its rows."""
+        size = self._size + X.nnz
+        self._data = _grow(self._data, size)
+        self._indices = _grow(self._indices, size)
+        self._data[self._size:size] = X.data[:X.nnz]
+        self._indices[self._size:size] = X.indices[:X.nnz]
+        bounds = self._size + X.indptr.astype(np.int64)
+        self._size = size
+        self.nnz += X.nnz
+        return bounds[:-1], bounds[1:]
+
+    def pad(self, n):
+        """Grows the rows (columns) to `n` entries, the new ones being zero."""
+        if n < self.n_cols:
+            raise ValueError("Expected n >= {}. Got {}".format(self.n_cols, n))
+        self.n_cols = n
+
+    def append(self, X):
+        """Appends the rows (columns) of `X`."""
+        X = self._as_rows(X)
+        n = self.n_rows + X.shape[0]
+        self._starts = _grow(self._starts, n)
+        self._ends = _grow(self._ends, n)
+        self._starts[self.n_rows:n], self._ends[self.n_rows:n] = self._write(X)
+        self.n_rows = n
+
+    def set(self, idx, X):
+        """Replaces the rows (columns) `idx`, which must be unique, by those of `X`."""
+        idx = np.asarray(idx, dtype=int)
+        X = self._as_rows(X)
+        if X.shape[0] != len(idx):
+            raise ValueError("Expected {} replacements. Got {}".format(len(idx), X.shape[0]))
+        self.nnz -= int(np.sum(self._ends[idx] - self._starts[idx]))
+        self._starts[idx], self._ends[idx] = self._write(X)
+        if self._size > 2 * self.nnz:
+            self._pack()
+
+    def _pack(self):
+        X = self._select(np.arange(self.n_rows))
+        self._data = _grow(X.data, 2 * X.nnz)
+        self._indices = _grow(X.indices, 2 * X.nnz)
+        self._starts[:self.n_rows] = X.indptr[:-1]
+        self._ends[:self.n_rows] = X.indptr[1:]
+        self._size = X.nnz
+
+
+class LRUCache():
+    """Least-recently-used cache bounded by the total size of its values in bytes."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._items = OrderedDict()
+        # the dashboard reads and fills caches from several threads
+        self._lock = threading.RLock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+    def __getitem__(self, key):
+        with self._lock:
+            value, _ = self._items[key]
+            self._items.move_to_end(key)
+            return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        size = nbytes(value)
+        with self._lock:
+            if key in self._items:
+                self.nbytes -= self._items.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            self._items[key] = (value, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self.nbytes -= evicted_size
+
+    def evict(self, predicate):
+        """Removes the items whose key satisfies `predicate`."""
+        with self._lock:
+            for key in [key for key in self._items if predicate(key)]:
+                self.nbytes -= self._items.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+
+class Superseded(Exception):
+    """Raised by a background job that stops early because a newer job superseded it."""
+
+
+class BackgroundWorker():
+    """Runs one job at a time in a background thread.
+
+    Submitting a job supersedes the previous one: a pending job is cancelled
+    and the result of a running job is discarded when it finishes. A running
+    job stops early if it checks `superseded` and raises `Superseded`.
+    """
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._lock = threading.Lock()
+        self._generation = 0
+        # superseded by both `submit` and `submit_idle`
+        self._idle_generation = 0
+        self._future = None
+        # kind and generation of the job running in the worker thread
+        self._running = threading.local()
+
+    def is_current(self, generation):
+        return generation == self._generation
+
+    def superseded(self):
+        """Whether the job running in the calling thread has been superseded."""
+        kind, generation = getattr(self._running, 'job', (None, None))
+        if kind == 'idle':
+            return generation != self._idle_generation
+        elif kind == 'job':
+            return not self.is_current(generation)
+        return False
+
+    @property
+    def busy(self):
+        return self._future is not None and not self._future.done()
+
+    def submit(self, fn, callback, on_error=None, name="job"):
+        """Runs `fn()` in the background and then `callback(result)` unless superseded.
+
+        Parameters
+        ----------
+        fn : callable
+            job to run
+        callback : callable
+            called with the result of `fn` in the worker thread
+        on_error : callable or None, optional (default: None)
+            called with the exception if `fn` or `callback` raises
+        name : str, optional (default: "job")
+            profiling stage spanning `fn` and `callback`
+
+        Returns
+        -------
+        generation : int
+            identifier of the job, see `is_current`
+        """
+        with self._lock:
+            self._generation += 1
+            self._idle_generation += 1
+            generation = self._generation
+            if self._future is not None:
+                self._future.cancel()
+
+            def run():
+                if not self.is_current(generation):
+                    return
+                self._running.job = ('job', generation)
+                try:
+                    with profiling.stage(name):
+                        result = fn()
+                        if self.is_current(generation):
+                            callback(result)
+                except Superseded:
+                    pass
+                except Exception as err:
+                    if on_error is None:
+                        raise
+                    on_error(err)
+
+            self._future = self._executor.submit(run)
+        return generation
+
+    def cancel(self):
+        """Supersedes any pending or running job."""
+        with self._lock:
+            self._generation += 1
+            self._idle_generation += 1
+            if self._future is not None:
+                self._future.cancel()
+
+    def submit_idle(self, fns, on_error=None, name="idle"):
+        """Queues low-priority jobs behind the current job.
+
+        Idle jobs do not supersede anything. They are skipped once `submit`
+        or `submit_idle` is called again, so a job submitted later waits at
+        most for the idle job that is already running.
+
+        Parameters
+        ----------
+        fns : list of callable
+            jobs to run in order. Their results are discarded.
+        on_error : callable or None, optional (default: None)
+            called with the exception if a job raises
+        name : str, optional (default: "idle")
+            profiling stage spanning each job
+        """
+        with self._lock:
+            self._idle_generation += 1
+            generation = self._idle_generation
+
+            def run(fn):
+                if generation != self._idle_generation:
+                    return
+                self._running.job = ('idle', generation)
+                try:
+                    with profiling.stage(name):
+                        fn()
+                except Superseded:
+                    pass
+                except Exception as err:
+                    if on_error is None:
+                        raise
+                    on_error(err)
+
+            for fn in fns:
+                self._executor.submit(run, fn)
+
+    def wait(self):
+        """Blocks until the current job has finished."""
+        future = self._future
+        if future is not None and not future.cancelled():
+            future.result()
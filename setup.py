@@ -16,6 +16,11 @@ install_requires = [
     'graph_coarsening @ git+https://github.com/loukasa/graph-coarsening',
 ]
 
+extras_require = {
+    'approximate': ['pynndescent'],
+    'test': ['pytest'],
+}
+
 package_name = "h_phate"
 
 version_py = os.path.join(os.path.dirname(
@@ -33,6 +38,7 @@ setup(name=package_name,
       packages=find_packages(),
       license='GNU General Public License Version 2',
       install_requires=install_requires,
+      extras_require=extras_require,
       long_description=readme,
       url='https://github.com/KrishnaswamyLab/h_phate_demo',
       download_url="https://github.com/KrishnaswamyLab/h_phate_demo/archive/v{}.tar.gz".format(
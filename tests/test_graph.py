@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+import pytest
+import scprep
+from scipy import sparse
+
+pytest.importorskip("graph_coarsening")
+
+from h_phate.graph import CoarseGraph, LazyAdjacency
+from h_phate.utils import PatchableSparse
+
+
+def _data(n_cells, n_genes=100, seed=42):
+    rng = np.random.RandomState(seed)
+    centers = rng.gamma(1, 1, (5, n_genes))
+    X = rng.poisson(centers[rng.randint(5, size=n_cells)]).astype(float)
+    return pd.DataFrame(X, columns=["g{}".format(i) for i in range(n_genes)])
+
+
+def _dense(X):
+    return (X.tosparse() if isinstance(X, PatchableSparse) else X).toarray()
+
+
+@pytest.mark.parametrize("size_weighted_expression", [False, True])
+def test_extend(size_weighted_expression):
+    data = _data(1300)
+    fitted, batches = data.iloc[:1000], [data.iloc[1000:1150], data.iloc[1150:]]
+    cg = CoarseGraph(size_weighted_expression=size_weighted_expression).fit(fitted)
+    W = _dense(cg.adjacency.W[0])
+    kernels = [cg._kernel_to_data(scprep.utils.to_array_or_spmatrix(batch)) for batch in batches]
+    # a block of the coarser levels, which extend keeps, and one that uses level 0
+    rows = np.arange(10)
+    kept = cg.adjacency.submatrix(2, 1, rows=rows)
+    cg.adjacency.submatrix(1, 0, rows=rows)
+    for batch in batches:
+        cg.extend(batch)
+    n_cells = len(data)
+    assert cg.level_sizes[0] == n_cells
+
+    # the fitted adjacency with the kernel of each batch to the fitted cells
+    K = sparse.vstack(kernels).toarray()
+    expected = np.zeros((n_cells, n_cells))
+    expected[:1000,:1000] = W
+    expected[1000:,:1000] = K
+    expected[:1000,1000:] = K.T
+    np.testing.assert_allclose(_dense(cg.adjacency.W[0]), expected)
+
+    # node sizes and expression as the fit would compute them from the extended hierarchy
+    leaves = cg.map_refine[(1, 0)]
+    np.testing.assert_array_equal(np.sort(leaves[leaves != -1]), np.arange(n_cells))
+    for level, node_sizes in cg._build_node_sizes().items():
+        np.testing.assert_allclose(cg.node_sizes[level], node_sizes)
+        assert np.sum(cg.node_sizes[level]) == n_cells
+    X = sparse.csr_matrix(scprep.utils.to_array_or_spmatrix(data[cg.gene_list]))
+    for level in range(cg.n_levels):
+        if level > 0:
+            X = cg._build_pooling(level) @ X
+        np.testing.assert_allclose(_dense(cg.gene_expression[level]),
+                                   X.T.multiply(cg._gene_scale[level][:,None]).toarray(), atol=1e-10)
+
+    # only the cached blocks that use level 0 were evicted
+    assert cg.adjacency.submatrix(2, 1, rows=rows) is kept
+    fresh = LazyAdjacency([_dense(W) for W in cg.adjacency.W],
+                          [_dense(C) for C in cg.coarseners])
+    for to_level in range(1, cg.n_levels):
+        np.testing.assert_allclose(cg.adjacency.submatrix(to_level, 0, rows=rows).toarray(),
+                                   fresh.submatrix(to_level, 0, rows=rows).toarray())
+    parents = cg.hierarchy.ancestors(0, 1)
+    np.testing.assert_array_equal(parents, cg.parents[0])
+
+
+def test_extend_array():
+    data = _data(600).to_numpy()
+    cg = CoarseGraph().fit(data[:500])
+    cg.extend(data[500:])
+    assert cg.level_sizes[0] == 600
+    assert cg.gene_expression[0].shape == (len(cg.gene_list), 600)
+    with pytest.raises(ValueError):
+        cg.extend(data[:10,:-1])
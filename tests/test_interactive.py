@@ -0,0 +1,101 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("graph_coarsening")
+
+from h_phate.graph import CoarseGraph
+from h_phate.interactive import InteractiveCoarseGraph
+
+
+@pytest.fixture(scope="module")
+def cg_op():
+    rng = np.random.RandomState(42)
+    centers = rng.gamma(1, 1, (5, 50))
+    X = rng.poisson(centers[rng.randint(5, size=600)]).astype(float)
+    return CoarseGraph().fit(pd.DataFrame(X, columns=["g{}".format(i) for i in range(50)]))
+
+
+def _select_nodes(level_nodes, select_idx):
+    """Selected nodes of each level, as the list-based view computed them."""
+    boundaries = np.concatenate([[0], np.cumsum([len(nodes) for nodes in level_nodes])])
+    return [nodes[select_idx[(select_idx >= boundaries[i]) & (select_idx < boundaries[i+1])] - boundaries[i]]
+            for i, nodes in enumerate(level_nodes)]
+
+
+def _children(cg_op, level_nodes):
+    """Children of the nodes of each level, as the baseline read them from `map_refine`."""
+    children = [np.setdiff1d(cg_op.map_refine[(i, i-1)][level_nodes[i]], [-1])
+                for i in range(1, cg_op.n_levels)] + [np.array([], dtype=int)]
+    children[0] = np.union1d(children[0], level_nodes[0])
+    return children
+
+
+def _refine(cg_op, level_nodes, select_idx, remove_deselected=False):
+    select_nodes = _select_nodes(level_nodes, select_idx)
+    refined_nodes = _children(cg_op, select_nodes)
+    for refined, expected in zip(cg_op.refine(select_nodes), refined_nodes):
+        np.testing.assert_array_equal(refined, expected)
+    if remove_deselected:
+        return refined_nodes
+    return [np.union1d(refined, np.setdiff1d(nodes, selected))
+            for refined, nodes, selected in zip(refined_nodes, level_nodes, select_nodes)]
+
+
+def _remove(level_nodes, select_idx):
+    return [np.setdiff1d(nodes, selected)
+            for nodes, selected in zip(level_nodes, _select_nodes(level_nodes, select_idx))]
+
+
+def _assert_view(icg_op, level_nodes):
+    assert len(icg_op.level_nodes) == len(level_nodes)
+    for nodes, expected in zip(icg_op.level_nodes, level_nodes):
+        np.testing.assert_array_equal(nodes, expected)
+
+
+def test_view(cg_op):
+    rng = np.random.RandomState(0)
+    icg_op = InteractiveCoarseGraph(cg_op)
+    history = [icg_op.level_nodes]
+    for _ in range(30):
+        level_nodes = history[-1]
+        n_nodes = sum(len(nodes) for nodes in level_nodes)
+        select_idx = np.sort(rng.choice(n_nodes, rng.randint(1, min(n_nodes, 40) + 1), replace=False))
+        for expected, selected in zip(_select_nodes(level_nodes, select_idx),
+                                      icg_op.select_nodes(select_idx)):
+            np.testing.assert_array_equal(selected, expected)
+        action = rng.choice(['refine', 'zoom', 'remove'] if n_nodes > 40 else ['refine', 'zoom'])
+        if action == 'remove':
+            icg_op.remove(select_idx)
+            expected = _remove(level_nodes, select_idx)
+        else:
+            icg_op.refine(select_idx, remove_deselected=action == 'zoom')
+            expected = _refine(cg_op, level_nodes, select_idx, remove_deselected=action == 'zoom')
+        _assert_view(icg_op, expected)
+        if any(not np.array_equal(a, b) for a, b in zip(expected, level_nodes)):
+            history.append(expected)
+
+    # back and forward walk the same views, bounded by history_size
+    n_back = 0
+    while icg_op.back():
+        n_back += 1
+        _assert_view(icg_op, history[-1 - n_back])
+    assert n_back == len(history) - 1
+    while icg_op.forward():
+        n_back -= 1
+        _assert_view(icg_op, history[-1 - n_back])
+    assert n_back == 0
+
+    # a new view after going back drops the views ahead of it
+    icg_op.back()
+    icg_op.remove(np.arange(1))
+    assert not icg_op.forward()
+
+
+def test_refine_to_level(cg_op):
+    icg_op = InteractiveCoarseGraph(cg_op)
+    top = cg_op.n_levels - 1
+    icg_op.refine(np.arange(3), to_level=0)
+    expected = [np.sort(cg_op.hierarchy.leaves(top, np.arange(3)))] + \
+        [np.array([], dtype=int)] * (top - 1) + [np.arange(3, cg_op.level_sizes[top])]
+    _assert_view(icg_op, expected)
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+from scipy import sparse
+
+pytest.importorskip("graph_coarsening")
+
+from h_phate.utils import PatchableSparse, append
+
+
+def _random(rng, shape, density=0.3):
+    return (rng.rand(*shape) < density) * rng.rand(*shape)
+
+
+@pytest.mark.parametrize("axis", [0, 1])
+def test_patchable_sparse(axis):
+    rng = np.random.RandomState(42)
+    D = _random(rng, (30, 20))
+    P = PatchableSparse(sparse.csr_matrix(D) if axis == 0 else sparse.csc_matrix(D), axis=axis)
+    for _ in range(300):
+        n_patched, n_entries = D.shape[axis], D.shape[1 - axis]
+        op = rng.randint(3)
+        if op == 0:
+            new = _random(rng, (rng.randint(4), n_entries))
+            P.append(sparse.csr_matrix(new if axis == 0 else new.T))
+            D = np.vstack([D, new]) if axis == 0 else np.hstack([D, new.T])
+        elif op == 1:
+            idx = rng.choice(n_patched, rng.randint(1, 6), replace=False)
+            new = _random(rng, (len(idx), n_entries), density=0.6)
+            P.set(idx, sparse.csr_matrix(new if axis == 0 else new.T))
+            if axis == 0:
+                D[idx] = new
+            else:
+                D[:,idx] = new.T
+        else:
+            P.pad(n_entries + 1)
+            D = (np.hstack([D, np.zeros((D.shape[0], 1))]) if axis == 0 else
+                 np.vstack([D, np.zeros((1, D.shape[1]))]))
+        assert P.shape == D.shape
+        assert P.nnz == np.count_nonzero(D)
+        np.testing.assert_allclose(P.tosparse().toarray(), D)
+    # rewriting the same entries packs the buffers instead of growing them
+    idx = np.arange(3)
+    new = _random(rng, (3, D.shape[1 - axis]), density=0.9)
+    sizes = []
+    for _ in range(50):
+        P.set(idx, sparse.csr_matrix(new if axis == 0 else new.T))
+        sizes.append(P._size)
+    if axis == 0:
+        D[idx] = new
+    else:
+        D[:,idx] = new.T
+    assert np.any(np.diff(sizes) < 0)
+    assert P._size <= 2 * P.nnz
+    np.testing.assert_allclose(P.tosparse().toarray(), D)
+    idx = rng.choice(D.shape[axis], 7)
+    np.testing.assert_allclose((P[idx] if axis == 0 else P[:,idx]).toarray(),
+                               D[idx] if axis == 0 else D[:,idx])
+    L = sparse.random(5, D.shape[0], density=0.2, format='csr', random_state=0)
+    np.testing.assert_allclose((L @ P).toarray(), L.toarray() @ D)
+    np.testing.assert_allclose((P @ sparse.eye(D.shape[1])).toarray(), D)
+
+
+def test_patchable_sparse_rejects_wrong_width():
+    P = PatchableSparse(sparse.eye(3, format='csr'))
+    with pytest.raises(ValueError):
+        P.append(sparse.csr_matrix((1, 4)))
+    with pytest.raises(ValueError):
+        P.set([0, 1], sparse.csr_matrix((1, 3)))
+    with pytest.raises(ValueError):
+        P.pad(2)
+
+
+def test_append():
+    a = np.arange(3)
+    b = append(a, [3, 4])
+    c = append(b, [5])
+    np.testing.assert_array_equal(a, np.arange(3))
+    np.testing.assert_array_equal(b, np.arange(5))
+    np.testing.assert_array_equal(c, np.arange(6))
+    # c was written into the spare room of b's buffer
+    assert c.base is b.base
+    # read-only arrays, e.g. memory-mapped ones, are copied
+    a.flags.writeable = False
+    np.testing.assert_array_equal(append(a, [3]), np.arange(4))